@@ -0,0 +1,68 @@
+import hashlib
+import os
+import re
+
+from flask import g
+
+from config import app
+
+# Files under static/build are generated. The ones whose name contains
+# their content hash (build/images/cover-300w.<hash>.webp) never change;
+# others, such as build/images.json, do.
+PREBUILT_DIR = 'build/'
+CONTENT_HASH = re.compile(r'\.[0-9a-f]{12}\.[^/]+$')
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+
+# style.css -> style.<hash>.css
+def fingerprinted_name(filename, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    stem, ext = os.path.splitext(filename)
+    return f"{stem}.{digest}{ext}"
+
+
+# Map every file under static/ to its fingerprinted name, and back
+def build_asset_manifest():
+    manifest = {}
+    for folder, _, files in os.walk(app.static_folder):
+        for name in files:
+            path = os.path.join(folder, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            if filename.startswith(PREBUILT_DIR):
+                continue
+            with open(path, 'rb') as f:
+                manifest[filename] = fingerprinted_name(filename, f.read())
+    return manifest, {fingerprinted: filename for filename, fingerprinted in manifest.items()}
+
+
+asset_manifest, asset_sources = build_asset_manifest()
+
+
+# url_for('static', filename='style.css') -> /static/style.<hash>.css
+# Skipped in debug mode, where files change without a restart.
+@app.url_defaults
+def fingerprint_static_url(endpoint, values):
+    if endpoint == 'static' and not app.debug:
+        filename = values.get('filename')
+        values['filename'] = asset_manifest.get(filename, filename)
+
+
+# Serve /static/style.<hash>.css from style.css
+@app.url_value_preprocessor
+def resolve_fingerprinted_static(endpoint, values):
+    if endpoint == 'static' and values:
+        filename = values.get('filename', '')
+        if filename in asset_sources:
+            values['filename'] = asset_sources[filename]
+            g._immutable_asset = True
+        elif filename.startswith(PREBUILT_DIR) and CONTENT_HASH.search(filename):
+            g._immutable_asset = True
+
+
+# A fingerprinted URL always means the same bytes, so browsers may keep it
+# for a year without revalidating
+@app.after_request
+def cache_immutable_assets(response):
+    if g.pop('_immutable_asset', False) and response.status_code == 200:
+        response.headers['Cache-Control'] = IMMUTABLE_CACHE_CONTROL
+    return response
@@ -1,52 +1,77 @@
-from flask_login import UserMixin, LoginManager
+from collections import namedtuple
+
+from flask_login import LoginManager
 from werkzeug.security import generate_password_hash, check_password_hash
-from config import app, get_db
+from config import app, get_read_db
+from cache import TTLCache
 
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Loaded users by id, so most authenticated requests skip the Users lookup.
+# Use user_cache.stats() for hit/miss counts when sizing it.
+user_cache = TTLCache(app.config['USER_CACHE_SIZE'], app.config['USER_CACHE_TTL'])
+
+
+# Normalise a stored role (1, '1', '1.0', None, '') to 0 or 1
+def parse_role(value):
+    if type(value) is int:
+        return value
+    if value is None or not str(value).strip():
+        return 0
+    return int(float(str(value)))
+
+
+# Immutable, compact user record: a tuple with named fields and no
+# per-instance __dict__. It implements the Flask-Login user interface
+# itself, as UserMixin has no __slots__ and would add one back.
+class User(namedtuple('UserRecord', ['id', 'username', 'real_name', 'email', 'role'])):
+    __slots__ = ()
 
-class User(UserMixin):
-    def __init__(self, id, username, real_name, email, role):
-        self.id = id
-        self.username = username
-        self.real_name = real_name
-        self.email = email
-        self._role = int(float(str(role))) if role is not None and str(
-            role).strip() else 0
+    is_active = True
+    is_authenticated = True
+    is_anonymous = False
+
+    def __new__(cls, id, username, real_name, email, role):
+        return tuple.__new__(cls, (id, username, real_name, email, parse_role(role)))
+
+    # Build from a Users row with named columns; the role is parsed once here
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['username'], row['real_name'], row['email'], row['role'])
 
     def get_id(self):
         return str(self.id)
 
-    @property
-    def role(self):
-        return self._role
 
-    @role.setter
-    def role(self, value):
-        self._role = int(float(str(value))) if value is not None and str(
-            value).strip() else 0
+# Build many users at once, e.g. for admin listings
+def users_from_rows(rows):
+    return [User.from_row(row) for row in rows]
+
+
+# Call whenever a Users row is changed or deleted
+def invalidate_user(user_id):
+    user_cache.invalidate(str(user_id))
 
 
 @login_manager.user_loader
 def load_user(user_id):
+    user = user_cache.get(str(user_id))
+    if user is not None:
+        return user
     try:
-        db = get_db()
+        db = get_read_db()
         cursor = db.execute(
-            "SELECT id, username, password, real_name, email, role FROM Users WHERE id = ?", (user_id,))
+            "SELECT id, username, real_name, email, role FROM Users WHERE id = ?", (user_id,))
         user_data = cursor.fetchone()
-        print("Loading user - user_id:", user_id, "user_data:", user_data)
 
         if user_data is not None:
-            user_id = user_data[0]
-            username = user_data[1]
-            real_name = user_data[3]
-            email = user_data[4]
-            role = int(float(str(user_data[5]))) if user_data[5] is not None and str(
-                user_data[5]).strip() else 0
-            return User(user_id, username, real_name, email, role)
+            user = User.from_row(user_data)
+            user_cache.set(str(user.id), user)
+            return user
         return None
     except Exception as e:
         print("Error in load_user:", e)
         return None
+
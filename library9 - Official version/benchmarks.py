@@ -0,0 +1,414 @@
+import contextlib
+import io
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import timeit
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from collections import Counter
+
+import click
+from flask_login import UserMixin
+from werkzeug.security import check_password_hash
+from werkzeug.serving import make_server
+
+import queries
+from auth import users_from_rows
+from config import app, connect_db, db_pool, read_pool
+from passwords import hash_password
+from pool import ConnectionPool
+from schema import MIGRATIONS, migrate
+
+# Benchmarks behind the performance work, as flask commands, with the
+# scratch databases and sample data they run on. None of them touch
+# library.db except to copy it.
+
+
+# Migrated copy of the live database in `folder`
+def scratch_copy(folder):
+    path = os.path.join(folder, 'library.db')
+    source = sqlite3.connect(app.config['DATABASE'])
+    copy = sqlite3.connect(path)
+    try:
+        source.backup(copy)
+        migrate(copy)
+    finally:
+        source.close()
+        copy.close()
+    return path
+
+
+# (p50, p99) of a list of timings, or (0, 0) if it is empty
+def percentiles(timings):
+    if not timings:
+        return 0, 0
+    timings = sorted(timings)
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.99))]
+
+
+# Call fn `rounds` times; returns (p50, p99) in microseconds
+def time_calls(fn, rounds):
+    timings = []
+    for _ in range(rounds):
+        start = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - start) * 1e6)
+    return percentiles(timings)
+
+
+SAMPLE_WORDS = ['harry', 'potter', 'history', 'garden', 'ocean', 'night', 'river', 'stone',
+                'dragon', 'science', 'kitchen', 'winter', 'city', 'secret', 'journey', 'music']
+SAMPLE_BORROW = '''INSERT INTO Borrows (book_ref, borrower_id, borrow_date, return_date, Instructions, update_time)
+                   VALUES (?, ?, ?, ?, ?, ?)'''
+
+
+# Synthetic Borrows row
+def sample_borrow(rng, users, books):
+    day = 20000 + rng.randrange(365)
+    return (rng.randint(1, books), rng.randint(1, users), day, day + rng.choice((7, 14)),
+            rng.choice(('', 'Leave at the front desk', 'Call before delivery')), int(time.time()))
+
+
+# Fill a freshly migrated database with users user1..userN, `books` books
+# and `rows` borrows spread over them
+def fill_sample_db(db, rows, users=1000, books=5000):
+    rng = random.Random(42)
+    db.executemany("INSERT INTO Users (username, password, role) VALUES (?, 'x', 0)",
+                   ((f'user{i}',) for i in range(1, users + 1)))
+    categories = [row[0] for row in db.execute("SELECT id FROM Categories")]
+    db.executemany("INSERT INTO Books (book_id, title, category_id) VALUES (?, ?, ?)",
+                   ((str(1000 + i), ' '.join(rng.sample(SAMPLE_WORDS, 3)).title(), rng.choice(categories))
+                    for i in range(books)))
+    db.executemany(SAMPLE_BORROW, (sample_borrow(rng, users, books) for _ in range(rows)))
+    db.commit()
+
+
+# Run list readers and borrow writers on their own connections for
+# `seconds`; returns (reads, writes, lock errors)
+def mixed_load(open_reader, open_writer, readers, writers, seconds):
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def run(connect, kind, op):
+        db = connect()
+        done = errors = 0
+        try:
+            while not stop.is_set():
+                try:
+                    op(db)
+                    done += 1
+                except sqlite3.OperationalError:
+                    errors += 1
+                    if db.in_transaction:
+                        db.rollback()
+        finally:
+            db.close()
+        with lock:
+            counts[kind] += done
+            counts['errors'] += errors
+
+    def read(db):
+        db.execute("SELECT * FROM BorrowDetails ORDER BY id DESC LIMIT 50").fetchall()
+
+    rng = random.Random()
+
+    def write(db):
+        db.execute(SAMPLE_BORROW, sample_borrow(rng, 100, 100))
+        db.commit()
+
+    threads = ([threading.Thread(target=run, args=(open_reader, 'reads', read)) for _ in range(readers)]
+               + [threading.Thread(target=run, args=(open_writer, 'writes', write)) for _ in range(writers)])
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return counts['reads'], counts['writes'], counts['errors']
+
+
+# The mutable User class auth.py used to have, for comparison
+class _LegacyUser(UserMixin):
+    def __init__(self, id, username, real_name, email, role):
+        self.id = id
+        self.username = username
+        self.real_name = real_name
+        self.email = email
+        self._role = int(float(str(role))) if role is not None and str(role).strip() else 0
+
+    @property
+    def role(self):
+        return self._role
+
+
+# Bytes allocated per object by build(rows), measured with tracemalloc
+def _bytes_per_user(build, rows):
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        users = build(rows)
+        allocated = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+    return (allocated - sys.getsizeof(users)) / len(rows)
+
+
+# The search borrowList ran before the FTS index: leading-wildcard LIKE,
+# a full scan of Borrows
+LIKE_SEARCH = """
+    SELECT * FROM BorrowDetails
+    WHERE book_title LIKE ? OR username LIKE ?
+"""
+
+
+# flask --app main hash-benchmark -m scrypt:16384:8:1 -m pbkdf2:sha256:600000
+@app.cli.command('hash-benchmark')
+@click.option('--method', '-m', 'methods', multiple=True,
+              help="Hash method to time, in werkzeug's method:params form.")
+@click.option('--rounds', default=20, show_default=True)
+def hash_benchmark_command(methods, rounds):
+    methods = methods or [app.config['PASSWORD_HASH_METHOD'],
+                          'scrypt:16384:8:1', 'pbkdf2:sha256:600000', 'pbkdf2:sha256:260000']
+    for method in methods:
+        pwhash = hash_password('benchmark-password', method)
+        p50, p99 = time_calls(lambda: check_password_hash(pwhash, 'benchmark-password'), rounds)
+        click.echo(f"{method:<24} login p50 {p50 / 1000:7.1f} ms   p99 {p99 / 1000:7.1f} ms")
+
+
+# flask --app main startup-benchmark
+# Database cost of one request before and after the schema moved out of
+# get_db(). The old get_db() opened library.db and ran both CREATE TABLE
+# statements and a commit on every request; now a request takes a warm
+# connection from the pool. Runs on a scratch copy of library.db.
+@app.cli.command('startup-benchmark')
+@click.option('--requests', 'rounds', default=2000, show_default=True)
+def startup_benchmark_command(rounds):
+    user_query = "SELECT id, username, real_name, email, role FROM Users WHERE id = ?"
+    with tempfile.TemporaryDirectory() as folder:
+        path = scratch_copy(folder)
+
+        def bootstrap_per_request():
+            db = sqlite3.connect(path)
+            db.row_factory = sqlite3.Row
+            for sql in MIGRATIONS[0][2]:
+                db.execute(sql)
+            db.commit()
+            db.execute(user_query, (1,)).fetchone()
+            db.close()
+
+        pool = ConnectionPool(lambda: connect_db(database=path), 1)
+
+        def pooled_connection():
+            db = pool.acquire()
+            db.execute(user_query, (1,)).fetchone()
+            pool.release(db)
+
+        try:
+            for name, request in (('open + CREATE TABLE + commit', bootstrap_per_request),
+                                  ('pooled get_db()', pooled_connection)):
+                p50, p99 = time_calls(request, rounds)
+                click.echo(f"{name:<30} p50 {p50:8.1f} us   p99 {p99:8.1f} us")
+        finally:
+            pool.close_all()
+
+
+# flask --app main concurrency-benchmark [--readers 4 --writers 2 --seconds 3]
+# Borrow list readers and borrow writers running together on a scratch
+# database. First the old setup: rollback journal and the same plain
+# connections for readers and writers. Then the current one: WAL,
+# DB_PRAGMAS and read-only connections for the readers.
+@app.cli.command('concurrency-benchmark')
+@click.option('--readers', default=4, show_default=True)
+@click.option('--writers', default=2, show_default=True)
+@click.option('--seconds', default=3.0, show_default=True)
+@click.option('--rows', default=20000, show_default=True, help="Borrows in the scratch database")
+def concurrency_benchmark_command(readers, writers, seconds, rows):
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'library.db')
+        db = sqlite3.connect(path)
+        try:
+            migrate(db)
+            fill_sample_db(db, rows, users=100, books=100)
+        finally:
+            db.close()
+
+        def plain_connection():
+            return sqlite3.connect(path, check_same_thread=False)
+
+        setups = [('rollback journal', 'DELETE', plain_connection, plain_connection),
+                  ('WAL + read-only readers', 'WAL',
+                   lambda: connect_db(readonly=True, database=path), lambda: connect_db(database=path))]
+        for name, journal_mode, open_reader, open_writer in setups:
+            db = sqlite3.connect(path)
+            db.execute(f"PRAGMA journal_mode = {journal_mode}")
+            db.close()
+            reads, writes, errors = mixed_load(open_reader, open_writer, readers, writers, seconds)
+            click.echo(f"{name:<24} {reads / seconds:9.0f} reads/s  {writes / seconds:9.0f} writes/s  "
+                       f"{errors} lock errors")
+
+
+# flask --app main search-benchmark [--rows 1000000] [-q user42 -q harry]
+# Times the old LIKE search against the FTS5 search on a scratch database
+# of synthetic borrows (users are user1..user1000). Both return every
+# match; the best of --rounds runs is shown.
+@app.cli.command('search-benchmark')
+@click.option('--rows', default=1000000, show_default=True, help="Borrows in the scratch database")
+@click.option('--query', '-q', 'texts', multiple=True, help="Search text. Default: user42, user999, harry")
+@click.option('--rounds', default=3, show_default=True)
+def search_benchmark_command(rows, texts, rounds):
+    texts = texts or ['user42', 'user999', 'harry']
+    with tempfile.TemporaryDirectory() as folder:
+        db = sqlite3.connect(os.path.join(folder, 'library.db'))
+        try:
+            start = time.perf_counter()
+            migrate(db)
+            fill_sample_db(db, rows)
+            click.echo(f"Built {rows} borrows in {time.perf_counter() - start:.0f} s")
+            for query in texts:
+                like = '%' + query + '%'
+                for name, sql, params in (('LIKE', LIKE_SEARCH, (like, like)),
+                                          ('FTS', queries.ADMIN_SEARCH, (queries.search_expression(query),))):
+                    best = None
+                    for _ in range(rounds):
+                        start = time.perf_counter()
+                        hits = len(db.execute(sql, params).fetchall())
+                        elapsed = (time.perf_counter() - start) * 1000
+                        best = elapsed if best is None else min(best, elapsed)
+                    click.echo(f"{query!r:<12} {name:<5} {hits:>8} hits  {best:8.1f} ms")
+        finally:
+            db.close()
+
+
+# flask --app main user-benchmark [--users 10000]
+# Construction time and memory of the User record against the old class,
+# for one user per request and for an admin listing of --users users.
+@app.cli.command('user-benchmark')
+@click.option('--users', 'count', default=10000, show_default=True)
+@click.option('--rounds', default=5, show_default=True)
+def user_benchmark_command(count, rounds):
+    db = sqlite3.connect(':memory:')
+    db.row_factory = sqlite3.Row
+    db.execute("CREATE TABLE Users (id INTEGER PRIMARY KEY, username TEXT, real_name TEXT, email TEXT, role)")
+    db.executemany("INSERT INTO Users VALUES (?, ?, ?, ?, ?)",
+                   ((i, f'user{i}', f'User {i}', f'user{i}@example.com', '1.0' if i % 10 == 0 else 0)
+                    for i in range(1, count + 1)))
+    rows = db.execute("SELECT id, username, real_name, email, role FROM Users").fetchall()
+    db.close()
+
+    def legacy_from_rows(rows):
+        return [_LegacyUser(row['id'], row['username'], row['real_name'], row['email'], row['role'])
+                for row in rows]
+
+    for name, build in (('old class', legacy_from_rows), ('User record', users_from_rows)):
+        row = rows[0]
+        one = min(timeit.repeat(lambda: build([row]), number=10000, repeat=rounds)) / 10000 * 1e6
+        many = min(timeit.repeat(lambda: build(rows), number=1, repeat=rounds)) * 1000
+        click.echo(f"{name:<12} per request {one:6.2f} us   {count} users {many:7.1f} ms   "
+                   f"{_bytes_per_user(build, rows):6.0f} bytes/user")
+
+
+# Serve the app on a local port from a background thread, against the
+# database at `path`; yields the base URL
+@contextlib.contextmanager
+def serve_scratch_app(path):
+    database = app.config['DATABASE']
+    app.config['DATABASE'] = path
+    db_pool.close_all()
+    read_pool.close_all()
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    level = logging.getLogger('werkzeug').level
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_port}"
+    finally:
+        server.shutdown()
+        thread.join()
+        logging.getLogger('werkzeug').setLevel(level)
+        app.config['DATABASE'] = database
+        db_pool.close_all()
+        read_pool.close_all()
+
+
+# GET url over and over until stop is set, recording latencies in ms
+def _poll(url, stop, latencies):
+    while not stop.is_set():
+        start = time.perf_counter()
+        with urllib.request.urlopen(url) as response:
+            response.read()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+# POST a wrong password for username until stop is set, counting statuses
+def _post_logins(url, username, stop, statuses, lock):
+    data = urllib.parse.urlencode({'username': username, 'password': 'wrong-password'}).encode()
+    while not stop.is_set():
+        try:
+            with urllib.request.urlopen(url, data) as response:
+                response.read()
+                status = response.status
+        except urllib.error.HTTPError as e:
+            status = e.code
+        with lock:
+            statuses[status] += 1
+
+
+# flask --app main login-storm [--logins 32 --pollers 2 --seconds 5]
+# Borrow list latency while --logins threads post wrong passwords for a
+# real user, against a scratch copy of library.db served on a local port.
+# Runs idle, then the storm with hashing inline on the request thread (the
+# old login), then with the bounded hashing pool. Login throttling is
+# lifted for the run, so every attempt reaches the password check.
+@app.cli.command('login-storm')
+@click.option('--logins', default=32, show_default=True, help="Threads posting wrong passwords")
+@click.option('--pollers', default=2, show_default=True, help="Threads loading the borrow list")
+@click.option('--seconds', default=5.0, show_default=True)
+@click.option('--username', default='user1', show_default=True, help="An existing user to log in as")
+def login_storm_command(logins, pollers, seconds, username):
+    # Loaded by now: the routes and login throttles under test live there
+    main = sys.modules['main']
+    limits = main.ip_limiter.limit, main.username_limiter.limit
+    main.ip_limiter.limit = main.username_limiter.limit = sys.maxsize
+    verify_password = main.verify_password
+    phases = [('idle', 0, verify_password),
+              ('storm, inline hashing', logins, check_password_hash),
+              ('storm, bounded pool', logins, verify_password)]
+    try:
+        with tempfile.TemporaryDirectory() as folder, serve_scratch_app(scratch_copy(folder)) as base:
+            for name, login_threads, verify in phases:
+                main.verify_password = verify
+                stop = threading.Event()
+                latencies = []
+                statuses = Counter()
+                lock = threading.Lock()
+                threads = ([threading.Thread(target=_post_logins,
+                                             args=(base + '/login', username, stop, statuses, lock))
+                            for _ in range(login_threads)]
+                           + [threading.Thread(target=_poll, args=(base + '/borrowList', stop, latencies))
+                              for _ in range(pollers)])
+                # login() prints every attempt
+                with contextlib.redirect_stdout(io.StringIO()):
+                    for thread in threads:
+                        thread.start()
+                    time.sleep(seconds)
+                    stop.set()
+                    for thread in threads:
+                        thread.join()
+                p50, p99 = percentiles(latencies)
+                logins_done = '  '.join(f"{status}: {count}" for status, count in sorted(statuses.items()))
+                click.echo(f"{name:<22} borrowList p50 {p50:7.1f} ms  p99 {p99:7.1f} ms  "
+                           f"({len(latencies)} loads)  logins {logins_done or '-'}")
+    finally:
+        main.verify_password = verify_password
+        main.ip_limiter.limit, main.username_limiter.limit = limits
+
@@ -0,0 +1,124 @@
+import time
+from datetime import date, datetime
+from functools import lru_cache
+
+# Shared by the borrow form and the bulk import, so both accept exactly
+# the same borrows
+BORROW_FIELDS_MESSAGE = "Please ensure that the Book ID, Category and Borrowing Period are all valid and selected."
+BORROW_DATE_MESSAGE = "The borrowing date or period is invalid."
+BOOK_CONFLICT_MESSAGE = ("Book ID {book_id} is already in the catalog{title} with a different title or category. "
+                         "Leave the title blank to use the catalog's, and pick its category.")
+
+BORROW_PERIODS = {'7days': 7, '14days': 14}
+
+# borrow_date and return_date are stored as day numbers (days since
+# 1970-01-01) and update_time as Unix seconds. Text is only parsed where
+# it comes in (forms, imports) and formatted where it goes out (templates,
+# exports).
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+# A borrow that fails validation. `status` is the HTTP status the borrow
+# form answers with.
+class InvalidBorrow(ValueError):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def day_number(d):
+    return d.toordinal() - EPOCH_ORDINAL
+
+
+def today():
+    return day_number(date.today())
+
+
+def now():
+    return int(time.time())
+
+
+# Day number of a YYYY-MM-DD string, or None if it is not a date
+def parse_day(text):
+    try:
+        return day_number(date.fromisoformat(text))
+    except (TypeError, ValueError):
+        return None
+
+
+# Jinja filter: day number -> YYYY-MM-DD. Few distinct days appear on a
+# page, so each is formatted once.
+@lru_cache(maxsize=4096)
+def format_day(day):
+    if day is None:
+        return ''
+    return date.fromordinal(day + EPOCH_ORDINAL).isoformat()
+
+
+# Jinja filter: Unix seconds -> local YYYY-MM-DD HH:MM:SS
+def format_timestamp(seconds):
+    if seconds is None:
+        return ''
+    return datetime.fromtimestamp(seconds).strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Return date calculation, in day numbers
+def calculate_return_date(borrow_date, borrow_period):
+    if borrow_period not in BORROW_PERIODS:
+        raise ValueError("Invalid borrow period")
+    return borrow_date + BORROW_PERIODS[borrow_period]
+
+
+# Check a borrow against the form rules and return its return date.
+# category_id is None when the category is not in the catalog, and
+# borrow_date (a day number) is None when it could not be parsed.
+def validate_borrow(book_id, category_id, borrow_date, borrow_period):
+    if not book_id or len(book_id) < 3 or category_id is None or not borrow_period:
+        raise InvalidBorrow(BORROW_FIELDS_MESSAGE, 404)
+    try:
+        return calculate_return_date(borrow_date, borrow_period)
+    except (ValueError, TypeError):
+        raise InvalidBorrow(BORROW_DATE_MESSAGE, 400)
+
+
+# Id of a category by name, or None if it is not in the catalog
+def find_category(db, name):
+    row = db.execute("SELECT id FROM Categories WHERE name = ?", (name,)).fetchone()
+    return row[0] if row else None
+
+
+# Every category as {name: id}, for validating many rows at once
+def category_ids(db):
+    return {name: id for id, name in db.execute("SELECT id, name FROM Categories")}
+
+
+# Reject a title or category that disagrees with the catalog entry for
+# book_id. Blank values, and values the catalog does not have yet, agree.
+def check_book(book_id, title, category_id, known_title, known_category_id):
+    if (title and known_title and title != known_title) or \
+            (category_id is not None and known_category_id is not None and category_id != known_category_id):
+        raise InvalidBorrow(BOOK_CONFLICT_MESSAGE.format(
+            book_id=book_id, title=f' as "{known_title}"' if known_title else ''), 400)
+
+
+# Id of the catalog entry for book_id, adding it if it is new. With
+# overwrite=True (an admin edit) the title and category are replaced;
+# otherwise they must agree with the catalog (see check_book) and are only
+# filled in where the catalog has none.
+def save_book(db, book_id, title, category_id, overwrite=False):
+    title = title or None
+    if not overwrite:
+        known = db.execute("SELECT title, category_id FROM Books WHERE book_id = ?", (book_id,)).fetchone()
+        if known:
+            check_book(book_id, title, category_id, known[0], known[1])
+    db.execute("INSERT INTO Books (book_id, title, category_id) VALUES (?, ?, ?) ON CONFLICT(book_id) DO NOTHING",
+               (book_id, title, category_id))
+    if overwrite:
+        db.execute("UPDATE Books SET title = ?, category_id = ? WHERE book_id = ?",
+                   (title, category_id, book_id))
+    else:
+        db.execute("""UPDATE Books SET title = COALESCE(title, ?), category_id = COALESCE(category_id, ?)
+                      WHERE book_id = ? AND (title IS NULL OR category_id IS NULL)""",
+                   (title, category_id, book_id))
+    return db.execute("SELECT id FROM Books WHERE book_id = ?", (book_id,)).fetchone()[0]
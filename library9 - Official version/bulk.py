@@ -0,0 +1,303 @@
+import csv
+import gzip
+import io
+import json
+import time
+from datetime import datetime
+
+import click
+
+from config import app, connect_db
+from borrows import InvalidBorrow, category_ids, check_book, now, parse_day, validate_borrow
+from compress import gzip_stream
+
+FORMATS = ('csv', 'jsonl')
+MIMETYPES = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+
+# Rows whose title or category disagree with the catalog are rejected in
+# parse(), so this only fills in what the catalog does not have yet
+BOOK_UPSERT = '''INSERT INTO Books (book_id, title, category_id) VALUES (?, ?, ?)
+                 ON CONFLICT(book_id) DO UPDATE SET title = COALESCE(title, excluded.title),
+                                                    category_id = COALESCE(category_id, excluded.category_id)
+                 WHERE title IS NULL OR category_id IS NULL'''
+BORROW_INSERT = '''INSERT INTO Borrows (book_ref, borrower_id, borrow_date, return_date, Instructions, update_time)
+                   VALUES (?, ?, ?, ?, ?, ?)'''
+# Fields read from a record. JSONL values may be of any JSON type, but
+# only text and whole numbers are accepted.
+IMPORT_FIELDS = ('book_id', 'book_title', 'category', 'borrower_id', 'username',
+                 'borrow_date', 'return_period', 'instructions', 'update_time')
+
+
+# csv or jsonl, from an explicit choice or the file name
+def import_format(filename, fmt=None):
+    if fmt:
+        return fmt
+    name = (filename or '').lower()
+    if name.endswith('.gz'):
+        name = name[:-3]
+    return 'jsonl' if name.endswith(('.jsonl', '.json', '.ndjson')) else 'csv'
+
+
+# (line number, record) for every row of a CSV or JSONL text stream.
+# The record is None for a JSONL line that is not an object.
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for row in reader:
+            yield reader.line_num, row
+        return
+    for line_no, line in enumerate(stream, 1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_no, row if isinstance(row, dict) else None
+
+
+# The part of a rejected record that is echoed back in error reports: only
+# the fields the import reads, so stray keys (a CSV row's extra fields end
+# up under None) cannot break the JSON they are written to
+def error_record(record):
+    if record is None:
+        return None
+    return {field: record[field] for field in IMPORT_FIELDS if field in record}
+
+
+# Loads borrow records in batches, one transaction and one executemany
+# per batch. Rows are validated with the borrow form rules; rejected rows
+# are passed to on_error(line, message, record) and skipped.
+class BorrowImporter:
+    def __init__(self, db, batch_size=None, on_error=None, on_progress=None):
+        self.db = db
+        self.batch_size = batch_size or app.config['IMPORT_BATCH_SIZE']
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self.update_time = now()
+        self.categories = category_ids(db)
+        self.user_ids = {}
+        self.usernames = {}
+        for id, username in db.execute("SELECT id, username FROM Users"):
+            self.user_ids[str(id)] = id
+            self.usernames[username] = id
+        # book_id -> (title, category_id) of the catalog plus the rows
+        # accepted so far, to reject rows that disagree with either
+        self.books = {book_id: (title, category_id) for book_id, title, category_id
+                      in db.execute("SELECT book_id, title, category_id FROM Books")}
+        # book_id -> (Books.id, has a title); filled as batches are written
+        self.book_refs = {}
+        self.imported = 0
+        self.rejected = 0
+
+    def _borrower(self, record):
+        borrower = record.get('borrower_id')
+        if borrower not in (None, '', 0, '0'):
+            if str(borrower) not in self.user_ids:
+                raise InvalidBorrow(f"Unknown borrower_id {borrower!r}")
+            return self.user_ids[str(borrower)]
+        username = record.get('username')
+        if username:
+            if username not in self.usernames:
+                raise InvalidBorrow(f"Unknown username {username!r}")
+            return self.usernames[username]
+        return None
+
+    # Unix seconds of a local 'YYYY-MM-DD HH:MM:SS', or the import time
+    def _update_time(self, text):
+        if not text:
+            return self.update_time
+        try:
+            return int(datetime.fromisoformat(text).timestamp())
+        except (TypeError, ValueError):
+            raise InvalidBorrow(f"Invalid update_time {text!r}")
+
+    # Validated (book_id, title, category_id, Borrows row) for one record
+    def parse(self, record):
+        if record is None:
+            raise InvalidBorrow("Not a JSON object")
+        # csv.DictReader files fields past the header under the None key
+        if None in record:
+            raise InvalidBorrow("Too many fields")
+        for field in IMPORT_FIELDS:
+            value = record.get(field)
+            if value is not None and type(value) not in (str, int):
+                raise InvalidBorrow(f"{field} must be text or a whole number, not {type(value).__name__}")
+        book_id = record.get('book_id')
+        book_id = str(book_id).strip() if book_id is not None else ''
+        category_id = self.categories.get(record.get('category'))
+        borrow_date = parse_day(record.get('borrow_date'))
+        return_date = validate_borrow(book_id, category_id, borrow_date, record.get('return_period'))
+        title = str(record['book_title']) if record.get('book_title') else None
+        known_title, known_category_id = self.books.get(book_id, (None, None))
+        check_book(book_id, title, category_id, known_title, known_category_id)
+        borrow = [self._borrower(record), borrow_date, return_date,
+                  record.get('instructions') or '', self._update_time(record.get('update_time'))]
+        self.books[book_id] = (known_title or title, known_category_id or category_id)
+        return book_id, title, category_id, borrow
+
+    def _write(self, batch):
+        db = self.db
+        books = [(book_id, title, category_id) for book_id, title, category_id, _ in batch
+                 if book_id not in self.book_refs or (title and not self.book_refs[book_id][1])]
+        try:
+            if books:
+                db.executemany(BOOK_UPSERT, books)
+                for book_id in {book[0] for book in books}:
+                    self.book_refs[book_id] = tuple(db.execute(
+                        "SELECT id, title IS NOT NULL FROM Books WHERE book_id = ?", (book_id,)).fetchone())
+            db.executemany(BORROW_INSERT, ([self.book_refs[book_id][0]] + borrow
+                                           for book_id, _, _, borrow in batch))
+            db.commit()
+        except Exception:
+            db.rollback()
+            # Refs read inside the rolled back transaction may be gone
+            self.book_refs.clear()
+            raise
+        self.imported += len(batch)
+        if self.on_progress:
+            self.on_progress(self.imported, self.rejected)
+
+    # Import every (line number, record); returns (imported, rejected)
+    def run(self, records):
+        batch = []
+        for line_no, record in records:
+            try:
+                batch.append(self.parse(record))
+            except InvalidBorrow as e:
+                self.rejected += 1
+                if self.on_error:
+                    self.on_error(line_no, e.message, error_record(record))
+                continue
+            if len(batch) >= self.batch_size:
+                self._write(batch)
+                batch = []
+        if batch:
+            self._write(batch)
+        return self.imported, self.rejected
+
+
+# The whole ledger in id order. Columns match what the import reads, so an
+# export can be imported again; return_period is derived from the dates.
+# Day numbers and Unix seconds are formatted by SQLite, not per row in Python.
+EXPORT_COLUMNS = ['id', 'book_id', 'book_title', 'category', 'borrower_id', 'username',
+                  'borrow_date', 'return_period', 'return_date', 'instructions', 'update_time']
+EXPORT_QUERY = '''SELECT id, book_id, book_title, category, borrower_id, username,
+                         date(borrow_date * 86400, 'unixepoch') AS borrow_date,
+                         CASE return_date - borrow_date
+                             WHEN 7 THEN '7days' WHEN 14 THEN '14days' END AS return_period,
+                         date(return_date * 86400, 'unixepoch') AS return_date,
+                         Instructions AS instructions,
+                         datetime(update_time, 'unixepoch', 'localtime') AS update_time
+                  FROM BorrowDetails
+                  ORDER BY id'''
+
+
+# Export text in chunks of chunk_rows rows, fetched with fetchmany so only
+# one chunk is ever in memory
+def export_chunks(db, fmt, chunk_rows=None):
+    chunk_rows = chunk_rows or app.config['EXPORT_CHUNK_ROWS']
+    cursor = db.execute(EXPORT_QUERY)
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.writer(buffer)
+        writer.writerow(EXPORT_COLUMNS)
+        write = writer.writerows
+    else:
+        def write(rows):
+            buffer.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + '\n'
+                              for row in rows)
+    while True:
+        rows = cursor.fetchmany(chunk_rows)
+        if not rows:
+            break
+        write(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+# Export as bytes, gzip-compressed if asked
+def export_stream(db, fmt, compress=False):
+    chunks = (chunk.encode('utf-8') for chunk in export_chunks(db, fmt))
+    return gzip_stream(chunks) if compress else chunks
+
+
+# borrows-20250101.csv, borrows-20250101.jsonl.gz, ...
+def export_filename(fmt, compress=False):
+    return f"borrows-{datetime.now():%Y%m%d}.{fmt}" + ('.gz' if compress else '')
+
+
+# flask --app main import-borrows loans.csv [--errors rejected.jsonl]
+# CSV needs a header row; JSONL is one object per line. Columns: book_id,
+# book_title, category, borrow_date (YYYY-MM-DD), return_period (7days or
+# 14days), instructions, update_time, and borrower_id or username.
+# Files ending in .gz are decompressed on the fly.
+@app.cli.command('import-borrows')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help="Default: from the file name")
+@click.option('--batch-size', type=int, help="Rows per transaction")
+@click.option('--errors', 'errors_path', type=click.Path(dir_okay=False),
+              help="Write rejected rows here as JSONL")
+def import_borrows_command(path, fmt, batch_size, errors_path):
+    fmt = import_format(path, fmt)
+    opener = gzip.open if path.endswith('.gz') else open
+    errors_file = open(errors_path, 'w', encoding='utf-8') if errors_path else None
+    start = time.perf_counter()
+
+    def on_error(line_no, message, record):
+        if errors_file:
+            errors_file.write(json.dumps({'line': line_no, 'error': message, 'record': record},
+                                         ensure_ascii=False) + '\n')
+
+    def on_progress(imported, rejected):
+        elapsed = time.perf_counter() - start
+        click.echo(f"{imported:>10} imported  {rejected:>8} rejected  {imported / elapsed:>8.0f} rows/s")
+
+    db = connect_db()
+    try:
+        with opener(path, 'rt', encoding='utf-8-sig', newline='') as f:
+            importer = BorrowImporter(db, batch_size, on_error, on_progress)
+            imported, rejected = importer.run(read_records(f, fmt))
+    finally:
+        db.close()
+        if errors_file:
+            errors_file.close()
+    click.echo(f"Imported {imported} borrows in {time.perf_counter() - start:.1f} s, rejected {rejected}"
+               + (f" (see {errors_path})" if rejected and errors_path else ""))
+
+
+# Text stream over an uploaded file, decompressing .gz uploads
+def upload_stream(upload):
+    raw = upload.stream
+    if (upload.filename or '').lower().endswith('.gz'):
+        raw = gzip.GzipFile(fileobj=raw)
+    return io.TextIOWrapper(raw, encoding='utf-8-sig', newline='')
+
+
+# flask --app main export-borrows borrows.csv.gz
+# Format and compression follow the file name unless given; '-' writes to
+# stdout. Reads from one snapshot, so the export is consistent even while
+# borrows are being written.
+@app.cli.command('export-borrows')
+@click.argument('path', type=click.Path(dir_okay=False, allow_dash=True))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), help="Default: from the file name")
+@click.option('--gzip/--no-gzip', 'compress', default=None, help="Default: when the file name ends in .gz")
+def export_borrows_command(path, fmt, compress):
+    fmt = import_format(path, fmt)
+    if compress is None:
+        compress = path.endswith('.gz')
+    start = time.perf_counter()
+    written = 0
+    db = connect_db(readonly=True)
+    try:
+        with click.open_file(path, 'wb') as f:
+            for data in export_stream(db, fmt, compress):
+                f.write(data)
+                written += len(data)
+    finally:
+        db.close()
+    if path != '-':
+        click.echo(f"Exported to {path}: {written} bytes in {time.perf_counter() - start:.1f} s")
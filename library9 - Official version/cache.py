@@ -0,0 +1,100 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# In-process LRU cache whose entries also expire after `ttl` seconds.
+# Safe to share between the threads of one worker.
+class TTLCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return None
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'max_entries': self.max_entries,
+                    'hits': self.hits, 'misses': self.misses}
+
+
+# LRU cache capped by the total size of its values in bytes rather than by
+# entry count. Each entry carries its own time to live.
+class SizedCache:
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                self._remove(key)
+            self.misses += 1
+            return None
+
+    def set(self, key, value, size, ttl):
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.monotonic() + ttl, value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def invalidate(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self._bytes,
+                    'max_bytes': self.max_bytes, 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, key):
+        self._bytes -= self._entries.pop(key)[2]
@@ -0,0 +1,153 @@
+import gzip
+import os
+import zlib
+
+import click
+from flask import request, send_file
+
+from assets import asset_manifest, fingerprinted_name
+from config import app
+
+# Brotli is optional; without it responses are gzip-compressed only
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Precompressed copies of static files, built by 'flask compress-static'.
+# They are named after the fingerprinted name (style.<hash>.css.gz), so a
+# copy is only ever served for the content it was made from.
+COMPRESSED_DIR = os.path.join(app.static_folder, 'build', 'compressed')
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+# Pick the best encoding the client accepts, or None
+def negotiate_encoding():
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br']:
+        return 'br'
+    if accepted['gzip']:
+        return 'gzip'
+    return None
+
+
+def _compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=app.config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(data, compresslevel=app.config['COMPRESS_LEVEL'])
+
+
+# gzip a streamed body chunk by chunk, so streaming stays constant-memory.
+# Each chunk is sync-flushed, otherwise zlib would hold the first one back
+# until it had a block's worth of later chunks.
+def gzip_stream(chunks):
+    compressor = zlib.compressobj(app.config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+# Swap a static file response for its precompressed copy, if one was built
+# from the current content of the file
+def _precompressed_static(response):
+    filename = request.view_args.get('filename', '')
+    fingerprinted = asset_manifest.get(filename)
+    if fingerprinted is None:
+        return response
+    source = os.path.join(app.static_folder, filename)
+    for encoding, suffix in SUFFIXES.items():
+        path = os.path.join(COMPRESSED_DIR, fingerprinted + suffix)
+        # The file may have been edited since the manifest was built
+        if (request.accept_encodings[encoding] and os.path.isfile(path)
+                and os.path.getmtime(path) >= os.path.getmtime(source)):
+            break
+    else:
+        return response
+    compressed = send_file(path, mimetype=response.mimetype, conditional=True,
+                           etag=f"{response.get_etag()[0] or ''}-{encoding}")
+    compressed.headers['Content-Encoding'] = encoding
+    compressed.headers['Cache-Control'] = response.headers.get('Cache-Control', '')
+    compressed.vary.add('Accept-Encoding')
+    response.close()
+    return compressed
+
+
+@app.after_request
+def compress_response(response):
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in app.config['COMPRESS_MIMETYPES']:
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = negotiate_encoding()
+    if encoding is None:
+        return response
+
+    if request.endpoint == 'static':
+        return _precompressed_static(response)
+    if response.direct_passthrough:
+        return response
+
+    if response.is_streamed:
+        if not request.accept_encodings['gzip']:
+            return response
+        response.response = gzip_stream(response.response)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < app.config['COMPRESS_MIN_SIZE']:
+            return response
+        response.set_data(_compress(data, encoding))
+        response.headers['Content-Encoding'] = encoding
+
+    # The body bytes changed, so a strong validator would be wrong
+    etag, weak = response.get_etag()
+    if etag and not weak:
+        response.set_etag(etag, weak=True)
+    return response
+
+
+# flask --app main compress-static
+# Copies left over from earlier versions of a file are removed.
+@app.cli.command('compress-static')
+def compress_static_command():
+    saved = 0
+    written = set()
+    for folder, _, files in os.walk(app.static_folder):
+        if folder.startswith(os.path.join(app.static_folder, 'build')):
+            continue
+        for name in files:
+            path = os.path.join(folder, name)
+            filename = os.path.relpath(path, app.static_folder).replace(os.sep, '/')
+            if not name.endswith(app.config['COMPRESS_STATIC_EXTENSIONS']):
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            fingerprinted = fingerprinted_name(filename, data)
+            for encoding, suffix in SUFFIXES.items():
+                if encoding == 'br' and brotli is None:
+                    continue
+                if encoding == 'br':
+                    compressed = brotli.compress(data, quality=11)
+                else:
+                    compressed = gzip.compress(data, compresslevel=9, mtime=0)
+                target = os.path.join(COMPRESSED_DIR, fingerprinted + suffix)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                with open(target, 'wb') as f:
+                    f.write(compressed)
+                written.add(os.path.normpath(target))
+                click.echo(f"{fingerprinted + suffix:<30} {len(data):8} -> {len(compressed):8} bytes")
+            saved += 1
+    removed = 0
+    for folder, _, files in os.walk(COMPRESSED_DIR):
+        for name in files:
+            path = os.path.normpath(os.path.join(folder, name))
+            if path not in written:
+                os.remove(path)
+                removed += 1
+    click.echo(f"Precompressed {saved} static files into {COMPRESSED_DIR}, removed {removed} stale copies")
@@ -1,44 +1,120 @@
 from flask import Flask, g
+from jinja2 import FileSystemBytecodeCache
+from pool import ConnectionPool
+from pathlib import Path
 import sqlite3
 import os
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.urandom(24).hex()
 app.config['SESSION_COOKIE_PARTITIONED'] = False
+app.config['DATABASE'] = 'library.db'
 
+# Compiled templates are kept on disk, so a restarted worker skips parsing.
+# 'flask compile-templates' fills the cache ahead of time.
+app.config['TEMPLATE_CACHE_DIR'] = os.path.join(app.root_path, '.jinja_cache')
+os.makedirs(app.config['TEMPLATE_CACHE_DIR'], exist_ok=True)
+app.jinja_options = {**app.jinja_options,
+                     'bytecode_cache': FileSystemBytecodeCache(app.config['TEMPLATE_CACHE_DIR'])}
+# At most DB_POOL_SIZE connections per pool; a request waits up to
+# DB_POOL_TIMEOUT seconds for one before it is answered with 503
+app.config['DB_POOL_SIZE'] = 8
+app.config['DB_POOL_TIMEOUT'] = 10
+app.config['DB_STATEMENT_CACHE'] = 128
+app.config['BORROW_PAGE_SIZE'] = 50
+app.config['BORROW_STREAM_CHUNK'] = 500
+# Most borrows one user may hold at a time; None for no limit
+app.config['BORROW_LIMIT'] = None
+app.config['USER_CACHE_SIZE'] = 1024
+app.config['USER_CACHE_TTL'] = 300
+app.config['PAGE_CACHE_MAX_BYTES'] = 1024 * 1024
 
+# Bulk import: rows per transaction, and how many rejected rows the
+# import endpoint reports back (the CLI can write all of them to a file).
+# Export: rows fetched and written per chunk.
+app.config['IMPORT_BATCH_SIZE'] = 5000
+app.config['IMPORT_ERROR_LIMIT'] = 100
+app.config['EXPORT_CHUNK_ROWS'] = 1000
+
+# Admin statistics. New borrows are folded into the cached figures as they
+# arrive; after edits or deletes the figures are recomputed at most every
+# STATS_MAX_AGE seconds.
+app.config['STATS_MAX_AGE'] = 60
+app.config['STATS_TOP_BOOKS'] = 10
+app.config['STATS_DAYS'] = 30
+
+# Response compression (gzip, or brotli when installed)
+app.config['COMPRESS_MIN_SIZE'] = 1024
+app.config['COMPRESS_LEVEL'] = 6
+app.config['COMPRESS_BROTLI_QUALITY'] = 5
+app.config['COMPRESS_MIMETYPES'] = ['text/html', 'text/css', 'text/plain', 'text/csv',
+                                    'application/json', 'application/x-ndjson', 'application/javascript']
+app.config['COMPRESS_STATIC_EXTENSIONS'] = ('.css', '.js', '.svg', '.json', '.txt')
+
+# Login protection: bounded password hashing and attempts per minute.
+# PASSWORD_HASH_METHOD is a werkzeug method string, e.g. 'scrypt',
+# 'scrypt:32768:8:1' or 'pbkdf2:sha256:600000'. Hashes made with another
+# method or cost are upgraded to it on the user's next successful login.
+app.config['PASSWORD_HASH_METHOD'] = 'scrypt:32768:8:1'
+app.config['PASSWORD_HASH_WORKERS'] = 2
+app.config['PASSWORD_HASH_QUEUE'] = 8
+app.config['LOGIN_ATTEMPTS_PER_IP'] = 20
+app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = 10
+app.config['LOGIN_ATTEMPT_WINDOW'] = 60
+
+# Applied to every new connection. journal_mode=WAL is persistent and is
+# switched on by init_db(), so readers keep going while a borrow is written.
+app.config['DB_PRAGMAS'] = {
+    'synchronous': 'NORMAL',
+    'cache_size': -16000,
+    'mmap_size': 64 * 1024 * 1024,
+    'temp_store': 'MEMORY',
+    'busy_timeout': 5000,
+}
+
+
+# `database` defaults to the DATABASE setting; benchmarks pass a scratch copy
+def connect_db(readonly=False, database=None):
+    database = database or app.config['DATABASE']
+    if readonly:
+        uri = Path(database).resolve().as_uri() + '?mode=ro'
+        db = sqlite3.connect(uri, uri=True, check_same_thread=False,
+                             cached_statements=app.config['DB_STATEMENT_CACHE'])
+    else:
+        db = sqlite3.connect(database, check_same_thread=False,
+                             cached_statements=app.config['DB_STATEMENT_CACHE'])
+    for name, value in app.config['DB_PRAGMAS'].items():
+        db.execute(f"PRAGMA {name} = {value}")
+    db.row_factory = sqlite3.Row
+    return db
+
+
+# Warm connections are kept between requests. Use .stats() for hit/miss counts.
+db_pool = ConnectionPool(connect_db, app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+read_pool = ConnectionPool(lambda: connect_db(readonly=True),
+                           app.config['DB_POOL_SIZE'], app.config['DB_POOL_TIMEOUT'])
+
+
+# The schema is created and migrated once at startup (see schema.py),
+# so a request only has to borrow a connection from the pool.
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect('library.db')
-
-        db.row_factory = sqlite3.Row
-        c = db.cursor()
-
-        # Borrows table
-        c.execute('''CREATE TABLE IF NOT EXISTS Borrows (
-                  id             INTEGER PRIMARY KEY,
-                  book_id        INTEGER,
-                  borrower_id    TEXT,
-                  book_title     TEXT,
-                  category       TEXT,
-                  picture        TEXT,
-                  borrow_date    TEXT,
-                  return_date    TEXT,
-                  Instructions   TEXT,
-                  update_time    TEXT,
-                  FOREIGN KEY (borrower_id) REFERENCES Users(id)
-                )''')
-
-        # Users table
-        c.execute('''CREATE TABLE IF NOT EXISTS Users (
-                  id             INTEGER PRIMARY KEY,
-                  username       TEXT UNIQUE NOT NULL,
-                  password       TEXT NOT NULL,
-                  real_name      TEXT,
-                  email          TEXT,
-                  role           INTEGER NOT NULL CHECK(role IN (0, 1))
-                )''')
-
-        db.commit()
+        db = g._database = db_pool.acquire()
+    return db
+
+
+# Read-only connection for list/search pages, never blocked by a writer
+def get_read_db():
+    db = getattr(g, '_read_database', None)
+    if db is None:
+        db = g._read_database = read_pool.acquire()
     return db
+
+
+# Give the read connection back before the request ends, ahead of slow
+# work that no longer needs it (password hashing on login)
+def release_read_db():
+    db = g.pop('_read_database', None)
+    if db is not None:
+        read_pool.release(db)
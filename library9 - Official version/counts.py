@@ -0,0 +1,80 @@
+import click
+
+from config import app, connect_db
+
+# UserBorrowCounts and CategoryBorrowCounts hold COUNT(*) of Borrows per
+# borrower and per category, kept up to date by triggers (see migration 8),
+# so reading a count is one primary key lookup. Guests are user 0 and
+# books without a category are category 0.
+SUMMARIES = {
+    'UserBorrowCounts': ('user_id', '''SELECT IFNULL(borrower_id, 0) AS user_id, COUNT(*)
+                                       FROM Borrows GROUP BY user_id'''),
+    'CategoryBorrowCounts': ('category_id', '''SELECT IFNULL(bk.category_id, 0) AS category_id, COUNT(*)
+                                               FROM Borrows b LEFT JOIN Books bk ON bk.id = b.book_ref
+                                               GROUP BY 1'''),
+}
+
+
+# Number of borrows held by a user
+def user_borrow_count(db, user_id):
+    row = db.execute("SELECT borrows FROM UserBorrowCounts WHERE user_id = ?", (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+# Number of borrows per category name, largest first
+def category_borrow_counts(db):
+    return db.execute("""
+        SELECT IFNULL(c.name, 'Uncategorised') AS name, s.borrows
+        FROM CategoryBorrowCounts s
+        LEFT JOIN Categories c ON c.id = s.category_id
+        WHERE s.borrows > 0
+        ORDER BY s.borrows DESC
+    """).fetchall()
+
+
+# {table: [(key, stored, actual)]} for every count that disagrees with a
+# fresh COUNT(*) over Borrows
+def find_count_mismatches(db):
+    mismatches = {}
+    for table, (key, sql) in SUMMARIES.items():
+        actual = dict(db.execute(sql).fetchall())
+        stored = dict(db.execute(f"SELECT {key}, borrows FROM {table}").fetchall())
+        wrong = [(k, stored.get(k, 0), actual.get(k, 0)) for k in sorted(actual.keys() | stored.keys())
+                 if stored.get(k, 0) != actual.get(k, 0)]
+        if wrong:
+            mismatches[table] = wrong
+    return mismatches
+
+
+# Recompute every summary table from Borrows, in one transaction
+def rebuild_counts(db):
+    db.execute("BEGIN IMMEDIATE")
+    try:
+        for table, (key, sql) in SUMMARIES.items():
+            db.execute(f"DELETE FROM {table}")
+            db.execute(f"INSERT INTO {table} ({key}, borrows) {sql}")
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+
+
+# flask --app main check-counts [--rebuild]
+@app.cli.command('check-counts')
+@click.option('--rebuild', is_flag=True, help="Recompute the summary tables from Borrows")
+def check_counts_command(rebuild):
+    db = connect_db()
+    try:
+        mismatches = find_count_mismatches(db)
+        for table, wrong in mismatches.items():
+            for key, stored, actual in wrong:
+                click.echo(f"{table} {key}: stored {stored}, actual {actual}")
+        if rebuild:
+            rebuild_counts(db)
+            click.echo("Rebuilt the summary tables from Borrows.")
+        elif mismatches:
+            raise click.ClickException("Summary counts are out of date, run with --rebuild.")
+        else:
+            click.echo("All summary counts match Borrows.")
+    finally:
+        db.close()
@@ -0,0 +1,123 @@
+import hashlib
+import io
+import json
+import os
+
+import click
+from markupsafe import Markup, escape
+
+from config import app
+
+# Pillow is only needed to build the images, not to serve them
+try:
+    from PIL import Image, features
+except ImportError:
+    Image = None
+
+# Cover widths to build. The about page shows covers 150-300px wide,
+# so this also covers 2x screens.
+COVER_WIDTHS = [150, 200, 300, 450, 600]
+COVER_SIZES = '(max-width: 700px) 150px, (max-width: 1000px) 200px, (max-width: 1300px) 250px, 300px'
+COVER_FORMATS = [('avif', 'AVIF', {'quality': 50}),
+                 ('webp', 'WEBP', {'quality': 75, 'method': 6}),
+                 ('jpg', 'JPEG', {'quality': 80, 'optimize': True, 'progressive': True})]
+
+SOURCE_DIR = os.path.join(app.static_folder, 'images')
+BUILD_DIR = os.path.join(app.static_folder, 'build', 'images')
+MANIFEST_PATH = os.path.join(app.static_folder, 'build', 'images.json')
+
+
+def load_manifest():
+    try:
+        with open(MANIFEST_PATH, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+# Built variants per source image: {filename: {ext: [[width, static path], ...]}}
+cover_manifest = load_manifest()
+
+
+# Write data under a name that contains its own hash, so the URL never has
+# to be revalidated: new content always means a new URL
+def _write_content_addressed(stem, width, ext, data):
+    digest = hashlib.sha256(data).hexdigest()[:12]
+    name = f"{stem}-{width}w.{digest}.{ext}"
+    path = os.path.join(BUILD_DIR, name)
+    if not os.path.exists(path):
+        with open(path, 'wb') as f:
+            f.write(data)
+    return f"build/images/{name}"
+
+
+def build_cover(filename):
+    stem = os.path.splitext(filename)[0]
+    variants = {}
+    with Image.open(os.path.join(SOURCE_DIR, filename)) as source:
+        source = source.convert('RGB')
+        for ext, pil_format, options in COVER_FORMATS:
+            if pil_format != 'JPEG' and not features.check(pil_format.lower()):
+                continue
+            for width in [w for w in COVER_WIDTHS if w <= source.width] or [source.width]:
+                height = round(source.height * width / source.width)
+                resized = source.resize((width, height), Image.LANCZOS)
+                buffer = io.BytesIO()
+                resized.save(buffer, pil_format, **options)
+                variants.setdefault(ext, []).append(
+                    [width, _write_content_addressed(stem, width, ext, buffer.getvalue())])
+    return variants
+
+
+# <picture> for a cover in static/images. Uses the built AVIF/WebP/JPEG
+# variants with srcset when they exist, the original file otherwise.
+def cover_picture(filename, alt, css_class='book-image'):
+    original = Markup('<img src="{}" alt="{}" class="{}">').format(
+        app.url_for('static', filename='images/' + filename), alt, css_class)
+    variants = cover_manifest.get(filename)
+    if not variants:
+        return original
+
+    def srcset(ext):
+        return ', '.join(f"{escape(app.url_for('static', filename=path))} {width}w"
+                         for width, path in variants[ext])
+
+    html = ['<picture>']
+    for ext in ('avif', 'webp'):
+        if ext in variants:
+            html.append(f'<source type="image/{ext}" srcset="{srcset(ext)}" sizes="{COVER_SIZES}">')
+    fallback = variants['jpg'][-1][1]
+    html.append(f'<img src="{escape(app.url_for("static", filename=fallback))}" srcset="{srcset("jpg")}" '
+                f'sizes="{COVER_SIZES}" alt="{escape(alt)}" class="{escape(css_class)}" loading="lazy">')
+    html.append('</picture>')
+    return Markup(''.join(html))
+
+
+app.jinja_env.globals['cover_picture'] = cover_picture
+
+
+# flask --app main build-images
+@app.cli.command('build-images')
+def build_images_command():
+    if Image is None:
+        raise click.ClickException("Pillow is required: pip install Pillow")
+    os.makedirs(BUILD_DIR, exist_ok=True)
+    manifest = {}
+    original_total = built_total = 0
+    for filename in sorted(os.listdir(SOURCE_DIR)):
+        if not filename.lower().endswith(('.jpg', '.jpeg', '.png')):
+            continue
+        manifest[filename] = variants = build_cover(filename)
+        original = os.path.getsize(os.path.join(SOURCE_DIR, filename))
+        # What a browser with AVIF support fetches for a 300px slot
+        best = next(iter(variants.values()))
+        chosen = next((path for width, path in best if width >= 300), best[-1][1])
+        built = os.path.getsize(os.path.join(app.static_folder, chosen))
+        original_total += original
+        built_total += built
+        click.echo(f"{filename:<50} {original // 1024:6} KB -> {built // 1024:4} KB")
+    with open(MANIFEST_PATH, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=1, ensure_ascii=False)
+    cover_manifest.clear()
+    cover_manifest.update(manifest)
+    click.echo(f"Covers: {original_total // 1024} KB -> {built_total // 1024} KB per about page view")
@@ -1,48 +1,122 @@
+import csv
+import hashlib
+import os
 import sqlite3
 
-from config import app, get_db
-from flask import render_template, request, g, abort, redirect, url_for
-from datetime import datetime, timedelta
+from config import app, get_db, get_read_db, db_pool, read_pool, release_read_db
+from schema import MIGRATIONS, migrate_on_startup
+import borrows
+from borrows import InvalidBorrow, calculate_return_date, find_category, save_book, validate_borrow
+import assets
+import benchmarks
+import bulk
+import compress
+import counts
+import images
+import overdue
+import stats
+import templating
+from pagination import Page, fetch_page, iter_rows
+from queries import (ADMIN_ALL, ADMIN_LIST, ADMIN_SEARCH, BOOK_BORROWS, EDIT_BORROW, GUEST_LIST, ID_KEY,
+                     RANK_KEY, UPDATE_BORROW, USER_LIST, USER_SEARCH, search_expression)
+from page_cache import cached_page
+from pool import PoolTimeout
+from passwords import HashPoolBusy, hash_password, needs_rehash, rehash_password, verify_password
+from throttle import RateLimiter
+from flask import render_template, request, g, abort, redirect, url_for, make_response, stream_template, jsonify, stream_with_context
+from datetime import datetime
 from flask_login import login_user, logout_user, login_required, current_user
-from auth import User, login_manager
-from werkzeug.security import generate_password_hash, check_password_hash
+from auth import User, invalidate_user, login_manager
 from functools import wraps
 
 app.jinja_env.globals['current_year'] = datetime.now().year
+app.jinja_env.filters['day'] = borrows.format_day
+app.jinja_env.filters['timestamp'] = borrows.format_timestamp
 
+# Apply any pending schema migrations once at startup, not per request
+migrate_on_startup()
 
-# Close the database
+
+# Return the database connections to their pools
 @app.teardown_appcontext
 def close_db(exception):
-    db = getattr(g, '_database', None)
+    db = g.pop('_database', None)
     if db is not None:
-        db.close()
-
-# Return date calculation
-
-
-def calculate_return_date(borrow_date, borrow_period):
-    borrow_dt = datetime.strptime(borrow_date, "%Y-%m-%d")
-
-    if borrow_period == '7days':
-        return_date = borrow_dt + timedelta(days=7)
-    elif borrow_period == '14days':
-        return_date = borrow_dt + timedelta(days=14)
-    else:
-        raise ValueError("Invalid borrow period")
+        db_pool.release(db)
+    db = g.pop('_read_database', None)
+    if db is not None:
+        read_pool.release(db)
+
+
+# Changes with every deploy that may render the lists differently: a new
+# schema version, or edited templates or static files. Computed once at
+# startup and mixed into every borrow list ETag.
+def deploy_epoch():
+    digest = hashlib.sha1(str(MIGRATIONS[-1][0]).encode())
+    template_folder = os.path.join(app.root_path, app.template_folder)
+    for folder, _, files in sorted(os.walk(template_folder)):
+        for name in sorted(files):
+            with open(os.path.join(folder, name), 'rb') as f:
+                digest.update(name.encode() + f.read())
+    digest.update(repr(sorted(assets.asset_manifest.items())).encode())
+    return digest.hexdigest()[:12]
+
+
+DEPLOY_EPOCH = deploy_epoch()
+
+
+# Strong ETag for one view of the borrow list. `scope` is 'all' for admins
+# or 'user:<id>'; its counter in BorrowVersions is bumped by triggers on
+# every change to the rows (or usernames) that view can show.
+def borrow_list_etag(db, scope):
+    row = db.execute("SELECT version FROM BorrowVersions WHERE scope = ?", (scope,)).fetchone()
+    user_id = current_user.id if current_user.is_authenticated else None
+    parts = [DEPLOY_EPOCH, scope, row[0] if row else 0, user_id, getattr(current_user, 'role', 0),
+             request.args.get('search', ''), request.args.get('after'),
+             request.args.get('before'), request.args.get('all'), app.config['BORROW_PAGE_SIZE']]
+    return hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+# Tag a borrow list response; clients must revalidate before reusing it
+def with_etag(response, etag):
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+
+# Join small template chunks into writes of at least `size` bytes. The
+# first write goes out at `first_size`, which is past the page and table
+# header, so the browser can start rendering before the rows are done.
+def buffered(chunks, size=16384, first_size=4096):
+    buffer = []
+    length = 0
+    threshold = first_size
+    for chunk in chunks:
+        buffer.append(chunk)
+        length += len(chunk)
+        if length >= threshold:
+            yield ''.join(buffer)
+            buffer = []
+            length = 0
+            threshold = size
+    if buffer:
+        yield ''.join(buffer)
+
+
+# Templates behind every page that extends layout.html
+LAYOUT_TEMPLATES = ['layout.html', 'header.html', 'nav.html', 'footer.html']
 
-    return return_date.strftime("%Y-%m-%d")
 
 # Home page route
-
-
 @app.route('/')
+@cached_page(ttl=300, templates=['home.html'] + LAYOUT_TEMPLATES)
 def home():
     return render_template('home.html', title='HOME')
 
 
 # About page route
 @app.route('/about')
+@cached_page(ttl=3600, templates=['about.html'] + LAYOUT_TEMPLATES)
 def about():
     return render_template('about.html', title='ABOUT')
 
@@ -53,6 +127,26 @@ def test():
     return render_template('test.html', title='TEST')
 
 
+# Store the password under the current hash policy. Skipped when the
+# hashing pool is busy, the next login will try again.
+def upgrade_password_hash(user_id, password):
+    try:
+        pwhash = rehash_password(password)
+    except HashPoolBusy:
+        return
+    db = get_db()
+    db.execute("UPDATE Users SET password = ? WHERE id = ?", (pwhash, user_id))
+    db.commit()
+    invalidate_user(user_id)
+
+
+# Login attempts allowed per client address and per username
+ip_limiter = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_IP'],
+                         app.config['LOGIN_ATTEMPT_WINDOW'])
+username_limiter = RateLimiter(app.config['LOGIN_ATTEMPTS_PER_USERNAME'],
+                               app.config['LOGIN_ATTEMPT_WINDOW'])
+
+
 # Login page route
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -63,14 +157,26 @@ def login():
         username = request.form.get('username', 'Not provided')
         password = request.form.get('password', 'Not provided')
 
-        db = get_db()
+        # Throttled before any lookup or hashing, so a flood is cheap to turn away
+        if not ip_limiter.hit(request.remote_addr) or not username_limiter.hit(username):
+            abort(429, description="Too many login attempts. Please wait a minute and try again.")
+
+        db = get_read_db()
         cursor = db.execute(
             "SELECT id, username, real_name, email, password, role FROM Users WHERE username = ?", (username,))
         user_data = cursor.fetchone()
+        # Hashing can queue for a while; don't hold a pooled connection meanwhile
+        release_read_db()
 
-        if user_data and check_password_hash(user_data[4], password):
-            user = User(user_data[0], user_data[1],
-                        user_data[2], user_data[3], user_data[5])
+        try:
+            valid = user_data is not None and verify_password(user_data[4], password)
+        except HashPoolBusy:
+            abort(503, description="The server is busy. Please try logging in again.")
+
+        if valid:
+            user = User.from_row(user_data)
+            if needs_rehash(user_data[4]):
+                upgrade_password_hash(user.id, password)
             login_user(user)
             return redirect(url_for('borrowList'))
         return render_template('login.html', title='Login', error="Invalid credentials")
@@ -104,103 +210,103 @@ def borrow():
         print(f"User data for borrower_id {borrower_id}: {user_data}")
         if not user_data:
             abort(404, description="User data not found")
-        username = user_data['username']
-        email = user_data['email']
 
         instructions = request.form.get('instructions', '')
-        borrow_date = datetime.now().strftime("%Y-%m-%d")
+        borrow_date = borrows.today()
         borrow_period = request.form.get('return_period')
-        update_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-
-        # 404
-        if len(book_id) < 3 or not category or not borrow_period:
-            abort(404, description="Please ensure that the Book ID, Category and Borrowing Period are all valid and selected.")
+        update_time = borrows.now()
 
-        # Calculate return date
+        # 404 for missing fields, 400 for a bad date or period
         try:
-            return_date = calculate_return_date(borrow_date, borrow_period)
-        except (ValueError, TypeError):
-            abort(400, description="The borrowing date or period is invalid.")
+            category_id = find_category(db, category)
+            return_date = validate_borrow(book_id, category_id, borrow_date, borrow_period)
+        except InvalidBorrow as e:
+            abort(e.status, description=e.message)
 
         db = get_db()
         c = db.cursor()
         try:
+            book_ref = save_book(db, book_id, book_title, category_id)
             c.execute('''
-                      INSERT INTO Borrows (book_id, book_title, category, borrower_id, borrow_date, return_date, instructions, update_time)
-                      VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                      ''', (book_id, book_title, category, borrower_id, borrow_date, return_date, instructions, update_time))
+                      INSERT INTO Borrows (book_ref, borrower_id, borrow_date, return_date, instructions, update_time)
+                      VALUES (?, ?, ?, ?, ?, ?)
+                      ''', (book_ref, borrower_id, borrow_date, return_date, instructions, update_time))
+            # Checked after the insert, while this transaction holds the
+            # write lock, so two borrows at once cannot both slip under it
+            limit = app.config['BORROW_LIMIT']
+            if limit is not None and counts.user_borrow_count(db, borrower_id) > limit:
+                db.rollback()
+                abort(400, description=f"You can borrow at most {limit} books at a time. Please return one first.")
             db.commit()
+        except InvalidBorrow as e:
+            db.rollback()
+            abort(e.status, description=e.message)
         except sqlite3.IntegrityError:
             db.rollback()
             abort(400)
 
-        return render_template('confirmation.html', title="Borrow Confirmed", username=username, email=email, borrow_date=borrow_date, return_date=return_date)
+        # Shown as stored: a blank title is filled in from the catalog
+        borrow = db.execute(EDIT_BORROW, (c.lastrowid,)).fetchone()
+        return render_template('confirmation.html', title="Borrow Confirmed", borrow=borrow)
     return render_template('borrow_form.html', title="Borrow")
 
 
-# Borrow list with search
+# Borrow list with search, one keyset page at a time
 @app.route('/borrowList')
 def borrowList():
     search_query = request.args.get('search', '')
-    db = get_db()
+    after = request.args.get('after')
+    before = request.args.get('before')
+    page_size = app.config['BORROW_PAGE_SIZE']
+    db = get_read_db()
     message = ""
 
+    # Nothing changed since the client's copy: skip the query and rendering
+    role = getattr(current_user, 'role', 0)
     if not current_user.is_authenticated:
-        cursor = db.execute("""
-            SELECT b.*, u.username, u.email 
-            FROM Borrows b 
-            LEFT JOIN Users u ON b.borrower_id = u.id 
-            WHERE b.borrower_id IS NULL OR b.borrower_id = 0
-        """)
-        borrows = cursor.fetchall()
-        return render_template('borrow_list_guest.html', borrows=borrows, search_query=search_query, message=message)
+        scope = 'user:0'
+    else:
+        scope = 'all' if role == 1 else f'user:{current_user.id}'
+    etag = borrow_list_etag(db, scope)
+    # Weak match, as a compressed response carries the weak form of the tag
+    if request.if_none_match.contains_weak(etag):
+        return with_etag(make_response('', 304), etag)
+
+    if not current_user.is_authenticated:
+        page = fetch_page(db, GUEST_LIST, (), ID_KEY, page_size, after, before)
+        return with_etag(make_response(render_template('borrow_list_guest.html', borrows=page.rows, page=page, search_query=search_query, message=message)), etag)
 
-    role = getattr(current_user, 'role', 0)
     if search_query:
-        if role == 1:
-            cursor = db.execute("""
-                SELECT b.*, u.username, u.email 
-                FROM Borrows b 
-                LEFT JOIN Users u ON b.borrower_id = u.id 
-                WHERE b.book_title LIKE ? OR u.username LIKE ? ORDER BY b.id ASC
-            """, ('%' + search_query + '%', '%' + search_query + '%'))
-            borrows = cursor.fetchall()
+        # Ranked full-text search over title, username, category and instructions
+        expression = search_expression(search_query)
+        if not expression:
+            page = Page([], None, None)
+        elif role == 1:
+            page = fetch_page(db, ADMIN_SEARCH, (expression,), RANK_KEY, page_size, after, before)
         else:
-            cursor = db.execute("""
-                SELECT b.*, u.username, u.email 
-                FROM Borrows b 
-                LEFT JOIN Users u ON b.borrower_id = u.id 
-                WHERE b.borrower_id = ? AND (b.book_title LIKE ? OR u.username LIKE ?) ORDER BY b.id ASC
-            """, (current_user.id, '%' + search_query + '%', '%' + search_query + '%'))
-            borrows = cursor.fetchall()
-        if not borrows:
+            page = fetch_page(db, USER_SEARCH, (expression, current_user.id), RANK_KEY, page_size, after, before)
+        if not page.rows:
             message = "The order you are looking for does not exist"
+    elif role == 1 and request.args.get('all'):
+        # Whole table for admins: the header goes out at once and rows are
+        # streamed from the cursor in chunks, never held in memory together
+        cursor = db.execute(ADMIN_ALL)
+        rows = iter_rows(cursor, app.config['BORROW_STREAM_CHUNK'])
+        return with_etag(app.response_class(buffered(stream_template('borrow_list_admin.html', borrows=rows, search_query='', message=''))), etag)
     else:
         if role == 1:
-            cursor = db.execute("""
-                SELECT b.*, u.username, u.email 
-                FROM Borrows b 
-                LEFT JOIN Users u ON b.borrower_id = u.id 
-                ORDER BY b.id ASC
-            """)
-            borrows = cursor.fetchall()
+            page = fetch_page(db, ADMIN_LIST, (), ID_KEY, page_size, after, before)
         else:
-            cursor = db.execute("""
-                SELECT b.*, u.username, u.email 
-                FROM Borrows b 
-                LEFT JOIN Users u ON b.borrower_id = u.id 
-                WHERE b.borrower_id = ? ORDER BY b.id ASC
-            """, (current_user.id,))
-            borrows = cursor.fetchall()
+            page = fetch_page(db, USER_LIST, (current_user.id,), ID_KEY, page_size, after, before)
 
-    return render_template('borrow_list_admin.html' if role == 1 else 'borrow_list_guest.html', borrows=borrows, search_query=search_query, message=message)
+    return with_etag(make_response(render_template('borrow_list_admin.html' if role == 1 else 'borrow_list_guest.html', borrows=page.rows, page=page, search_query=search_query, message=message)), etag)
 
 
 # Administrator privileges
 def admin_required(f):
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or current_user.role != 'admin':
+        if not current_user.is_authenticated or current_user.role != 1:
             abort(403)
         return f(*args, **kwargs)
     return decorated_function
@@ -210,23 +316,17 @@ def admin_required(f):
 @login_required
 @app.route('/edit_borrow/<int:id>')
 def edit_borrow(id):
-    db = get_db()
-    cursor = db.execute("""
-        SELECT b.*, u.username, u.email 
-        FROM Borrows b 
-        LEFT JOIN Users u ON b.borrower_id = u.id 
-        WHERE b.id = ?
-    """, (id,))
+    db = get_read_db()
+    cursor = db.execute(EDIT_BORROW, (id,))
     borrow = cursor.fetchone()
 
     if borrow is None:
         abort(404)
-    from datetime import datetime
-    borrow_date = datetime.strptime(
-        borrow['borrow_date'], '%Y-%m-%d') if borrow['borrow_date'] else None
-    return_date = datetime.strptime(
-        borrow['return_date'], '%Y-%m-%d') if borrow['return_date'] else None
-    return render_template('borrow_edit.html', borrow=borrow, borrow_date=borrow_date, return_date=return_date)
+    # The title and category belong to the book, so the form says how many
+    # borrows an edit to them will change
+    book_borrows = db.execute(BOOK_BORROWS, (borrow['book_ref'],)).fetchone()[0]
+    return render_template('borrow_edit.html', borrow=borrow, borrow_date=borrow['borrow_date'],
+                           return_date=borrow['return_date'], book_borrows=book_borrows)
 
 
 # Update borrow list
@@ -235,7 +335,7 @@ def edit_borrow(id):
 def update_borrow(id):
     db = get_db()
 
-    cursor = db.execute("SELECT * FROM Borrows WHERE id = ?", (id,))
+    cursor = db.execute(UPDATE_BORROW, (id,))
 
     original_borrow = cursor.fetchone()
     if original_borrow is None:
@@ -245,10 +345,9 @@ def update_borrow(id):
     book_title = request.form['book_title']
     category = request.form['category']
 
-    borrower_id = original_borrow[1]
+    borrower_id = original_borrow['borrower_id']
 
-    borrow_date = request.form.get(
-        'borrow_date', datetime.now().strftime('%Y-%m-%d'))
+    borrow_date = borrows.parse_day(request.form['borrow_date']) if 'borrow_date' in request.form else borrows.today()
     return_period = request.form['return_period']
     instructions = request.form['instructions']
 
@@ -257,44 +356,28 @@ def update_borrow(id):
     except (ValueError, TypeError):
         abort(400, description="The borrowing date or period is invalid.")
 
-    update_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    category_id = find_category(db, category)
+    if category_id is None:
+        abort(400, description="The category is invalid.")
+
+    update_time = borrows.now()
 
     db = get_db()
+    book_ref = save_book(db, book_id, book_title, category_id, overwrite=True)
     db.execute("""
         UPDATE Borrows 
         SET 
-            book_id = ?, 
-            book_title = ?, 
-            category = ?, 
-            
-            
+            book_ref = ?, 
             borrow_date = ?, 
             return_date = ?, 
             instructions = ?, 
             update_time = ?
         WHERE id = ?
-    """, (book_id, book_title, category, borrow_date, return_date, instructions, update_time, id))
-
-    cursor = db.execute("""
-        SELECT b.*, u.username, u.email 
-        FROM Borrows b 
-        LEFT JOIN Users u ON b.borrower_id = u.id 
-        WHERE b.id = ?
-    """, (id,))
-    borrow = cursor.fetchone()
-    if borrow is None:
-        abort(404)
-
-    cursor = db.execute("""
-        SELECT b.*, u.username, u.email 
-        FROM Borrows b 
-        LEFT JOIN Users u ON b.borrower_id = u.id 
-        ORDER BY b.id ASC
-    """)
-
-    borrows = cursor.fetchall()
+    """, (book_ref, borrow_date, return_date, instructions, update_time, id))
     db.commit()
-    return render_template('borrow_list_admin.html', borrows=borrows, search_query='', message='')
+
+    # Post/redirect/get: the list page is fetched fresh, one page at a time
+    return redirect(url_for('borrowList'))
 
 
 # Delete borrow list
@@ -303,15 +386,93 @@ def update_borrow(id):
 def delete_borrow(id):
     db = get_db()
     db.execute("DELETE FROM Borrows WHERE id = ?", (id,))
-    cursor = db.execute("SELECT * FROM Borrows ORDER BY id ASC")
-    borrows = cursor.fetchall()
     db.commit()
 
-    return render_template('borrow_list_admin.html', borrows=borrows, search_query='', message='')
+    return redirect(url_for('borrowList'))
+
+
+# Overdue borrows, or with ?days=N those due within N days. Admins see
+# every borrower's, users their own.
+@app.route('/overdue')
+@login_required
+def overdue_list():
+    days = request.args.get('days', type=int)
+    if days is not None and not 0 <= days <= 365:
+        abort(400, description="days must be between 0 and 365.")
+    borrower_id = None if current_user.role == 1 else current_user.id
+    page = overdue.due_page(get_read_db(), overdue.today(), days, borrower_id,
+                            app.config['BORROW_PAGE_SIZE'], request.args.get('after'), request.args.get('before'))
+    return render_template('overdue.html', title='Overdue', borrows=page.rows, page=page, days=days)
+
+
+# Overdue count per borrower, for following up
+@app.route('/overdue_report')
+@admin_required
+def overdue_report():
+    on = overdue.today()
+    borrowers = overdue.overdue_by_borrower(get_read_db(), on)
+    return render_template('overdue_report.html', title='Overdue Report', borrowers=borrowers, on=on)
+
+
+# Loan statistics for admins
+@app.route('/stats')
+@admin_required
+def loan_stats():
+    figures = stats.dashboard(get_read_db(), borrows.today())
+    return render_template('stats.html', title='Statistics', stats=figures)
+
+
+# Bulk import of borrows from an uploaded CSV or JSONL file (optionally .gz)
+@app.route('/import_borrows', methods=['POST'])
+@admin_required
+def import_borrows():
+    upload = request.files.get('file')
+    if upload is None or not upload.filename:
+        abort(400, description="Please choose a CSV or JSONL file to import.")
+    fmt = bulk.import_format(upload.filename, request.form.get('format'))
+    if fmt not in bulk.FORMATS:
+        abort(400, description="The import format must be csv or jsonl.")
+
+    errors = []
+
+    def on_error(line_no, message, record):
+        if len(errors) < app.config['IMPORT_ERROR_LIMIT']:
+            errors.append({'line': line_no, 'error': message, 'record': record})
+
+    importer = bulk.BorrowImporter(get_db(), on_error=on_error)
+    try:
+        imported, rejected = importer.run(bulk.read_records(bulk.upload_stream(upload), fmt))
+    except (UnicodeDecodeError, OSError, csv.Error) as e:
+        # Batches before the unreadable part are already committed
+        return jsonify(imported=importer.imported, rejected=importer.rejected, errors=errors,
+                       error=f"Stopped reading the file: {e}"), 400
+    return jsonify(imported=imported, rejected=rejected, errors=errors)
+
+
+# Streaming export of every borrow as CSV or JSONL, gzipped with ?gzip=1
+@app.route('/export_borrows')
+@admin_required
+def export_borrows():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in bulk.FORMATS:
+        abort(400, description="The export format must be csv or jsonl.")
+    compressed = request.args.get('gzip') == '1'
+    response = app.response_class(stream_with_context(bulk.export_stream(get_read_db(), fmt, compressed)),
+                                  mimetype='application/gzip' if compressed else bulk.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename="{bulk.export_filename(fmt, compressed)}"'
+    response.headers['Cache-Control'] = 'private, no-store'
+    return response
+
+
+# Every pooled connection stayed busy for DB_POOL_TIMEOUT seconds
+@app.errorhandler(PoolTimeout)
+def pool_timeout(e):
+    return "The server is busy. Please try again in a moment.", 503
 
 
 # Custom 404 error handler
 @app.errorhandler(404)
+@cached_page(ttl=3600, templates=['404.html'], by_login=False)
 def not_found(e):
     return render_template('404.html'), 404
 
@@ -324,7 +485,8 @@ if __name__ == '__main__':
         if c.fetchone()[0] == 0:
             c.execute("DELETE FROM Users")
             c.execute("INSERT INTO Users (username, password, real_name, email, role) VALUES (?, ?, ?, ?, ?)",
-                      ("admin", generate_password_hash("admin123"), "Admin User", "admin@example.com", 1))
+                      ("admin", hash_password("admin123"), "Admin User", "admin@example.com", 1))
             c.execute("INSERT INTO Users (username, password, real_name, email, role) VALUES (?, ?, ?, ?, ?)",
-                      ("user1", generate_password_hash("user123"), "User One", "user1@example.com", 0))
+                      ("user1", hash_password("user123"), "User One", "user1@example.com", 0))
+            db.commit()
     app.run(debug=True)
@@ -0,0 +1,103 @@
+import json
+
+import click
+
+from borrows import format_day, parse_day, today
+from config import app, connect_db
+from pagination import fetch_page
+
+# Due dates are stored as day numbers, so every filter below is an integer
+# range on idx_borrows_return_date (or on idx_borrows_borrower_due for one
+# borrower). Today's day number is computed once per request; no row is
+# ever compared in Python.
+DUE_KEY = [('return_date', int), ('id', int)]
+
+DUE_COLUMNS = "*, ? - return_date AS days_overdue"
+
+
+# WHERE clause and params: overdue on `on`, or, with due_within days,
+# due between `on` and `on` + due_within
+def due_condition(on, due_within=None):
+    if due_within is None:
+        return "return_date < ?", (on,)
+    return "return_date >= ? AND return_date <= ?", (on, on + due_within)
+
+
+# SELECT and params behind due_page, also planned by check-query-plans
+def due_query(on, due_within=None, borrower_id=None):
+    condition, params = due_condition(on, due_within)
+    if borrower_id is not None:
+        condition += " AND borrower_id = ?"
+        params += (borrower_id,)
+    return f"SELECT {DUE_COLUMNS} FROM BorrowDetails WHERE {condition}", (on,) + params
+
+
+# One page of overdue (or due soon) borrows, earliest due first
+def due_page(db, on, due_within=None, borrower_id=None, page_size=50, after=None, before=None):
+    sql, params = due_query(on, due_within, borrower_id)
+    return fetch_page(db, sql, params, DUE_KEY, page_size, after, before)
+
+
+# Overdue count and oldest due date per borrower, most overdue first.
+# Reads only idx_borrows_borrower_due, never the table itself.
+def overdue_by_borrower(db, on):
+    return db.execute("""
+        SELECT o.borrower_id, u.username, u.email, o.overdue, o.oldest_due
+        FROM (SELECT borrower_id, COUNT(*) AS overdue, MIN(return_date) AS oldest_due
+              FROM Borrows
+              WHERE return_date < ?
+              GROUP BY borrower_id) o
+        LEFT JOIN Users u ON u.id = o.borrower_id
+        ORDER BY o.overdue DESC, o.borrower_id
+    """, (on,)).fetchall()
+
+
+# Every overdue borrow, grouped by borrower: yields (borrower row, [borrows])
+def overdue_per_borrower(db, on, chunk_size=None):
+    chunk_size = chunk_size or app.config['BORROW_STREAM_CHUNK']
+    for borrower in overdue_by_borrower(db, on):
+        if borrower['borrower_id'] is None:
+            condition, params = "borrower_id IS NULL AND return_date < ?", (on,)
+        else:
+            condition, params = "borrower_id = ? AND return_date < ?", (borrower['borrower_id'], on)
+        cursor = db.execute(f"""SELECT {DUE_COLUMNS} FROM BorrowDetails WHERE {condition}
+                                ORDER BY return_date, id""", (on,) + params)
+        yield borrower, cursor.fetchmany(chunk_size)
+
+
+# flask --app main overdue-report [--date 2025-01-31] [--format jsonl]
+# Meant to run daily from cron: lists overdue borrows per borrower, at
+# most BORROW_STREAM_CHUNK of them per borrower.
+@app.cli.command('overdue-report')
+@click.option('--date', 'on', help="Report as of this YYYY-MM-DD date (default: today)")
+@click.option('--format', 'fmt', type=click.Choice(['text', 'jsonl']), default='text')
+def overdue_report_command(on, fmt):
+    if on is None:
+        on = today()
+    elif parse_day(on) is None:
+        raise click.BadParameter("expected YYYY-MM-DD", param_hint='--date')
+    else:
+        on = parse_day(on)
+    db = connect_db(readonly=True)
+    total = 0
+    try:
+        for borrower, borrows in overdue_per_borrower(db, on):
+            total += borrower['overdue']
+            if fmt == 'jsonl':
+                click.echo(json.dumps({**dict(borrower), 'oldest_due': format_day(borrower['oldest_due']), 'borrows': [
+                    {'id': b['id'], 'book_id': b['book_id'], 'book_title': b['book_title'],
+                     'return_date': format_day(b['return_date']), 'days_overdue': b['days_overdue']} for b in borrows]},
+                    ensure_ascii=False))
+                continue
+            name = borrower['username'] or 'No borrower'
+            email = f" <{borrower['email']}>" if borrower['email'] else ''
+            click.echo(f"{name}{email}: {borrower['overdue']} overdue, oldest due {format_day(borrower['oldest_due'])}")
+            for b in borrows:
+                click.echo(f"    #{b['id']:<8} due {format_day(b['return_date'])} ({b['days_overdue']} days)  "
+                           f"{b['book_id']}  {b['book_title'] or ''}")
+            if borrower['overdue'] > len(borrows):
+                click.echo(f"    ... and {borrower['overdue'] - len(borrows)} more")
+    finally:
+        db.close()
+    if fmt == 'text':
+        click.echo(f"{total} overdue borrows as of {format_day(on)}")
@@ -0,0 +1,44 @@
+import os
+from functools import wraps
+
+from flask import make_response
+from flask_login import current_user
+
+from cache import SizedCache
+from config import app
+
+# Rendered pages that are the same for every visitor, see cached_page()
+page_cache = SizedCache(app.config['PAGE_CACHE_MAX_BYTES'])
+
+
+# Modification times of the templates a page is built from
+def _templates_signature(templates):
+    folder = os.path.join(app.root_path, app.template_folder)
+    return tuple(os.path.getmtime(os.path.join(folder, name)) for name in templates)
+
+
+# Serve a page from memory for `ttl` seconds without touching Jinja.
+# `templates` lists every template the page renders, including layout.html
+# and its includes. When templates are reloaded (debug mode) an edit to any
+# of them invalidates the page. With by_login=True logged-in and anonymous
+# visitors get separate copies, as the nav and footer differ between them.
+def cached_page(ttl, templates, by_login=True):
+    def decorator(f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            key = (f.__name__, current_user.is_authenticated if by_login else None)
+            check_templates = app.jinja_env.auto_reload
+            entry = page_cache.get(key)
+            if entry is not None:
+                body, status, mimetype, signature = entry
+                if not check_templates or signature == _templates_signature(templates):
+                    return app.response_class(body, status=status, mimetype=mimetype)
+
+            signature = _templates_signature(templates) if check_templates else None
+            response = make_response(f(*args, **kwargs))
+            body = response.get_data()
+            page_cache.set(key, (body, response.status_code, response.mimetype, signature),
+                           len(body), ttl)
+            return response
+        return decorated_function
+    return decorator
@@ -0,0 +1,67 @@
+from collections import namedtuple
+
+
+Page = namedtuple('Page', ['rows', 'next_cursor', 'prev_cursor'])
+
+
+def make_cursor(row, key):
+    return ','.join(str(row[name]) for name, _ in key)
+
+
+def parse_cursor(text, key):
+    values = text.split(',')
+    if len(values) != len(key):
+        return None
+    try:
+        return tuple(kind(value) for (_, kind), value in zip(key, values))
+    except ValueError:
+        return None
+
+
+# The statement and parameters fetch_page runs for one page, the parsed
+# cursor, and whether the page is read backwards
+def page_query(sql, params, key, page_size, after=None, before=None):
+    backwards = bool(before)
+    cursor = parse_cursor(before or after, key) if (before or after) else None
+    columns = ', '.join(name for name, _ in key)
+    direction = 'DESC' if backwards else 'ASC'
+    order = ', '.join(f"{name} {direction}" for name, _ in key)
+
+    where = ''
+    if cursor is not None:
+        placeholders = ', '.join('?' for _ in key)
+        where = f"WHERE ({columns}) {'<' if backwards else '>'} ({placeholders})"
+    else:
+        backwards = False
+
+    return (f"SELECT * FROM ({sql}) {where} ORDER BY {order} LIMIT ?",
+            tuple(params) + (cursor or ()) + (page_size + 1,), cursor, backwards)
+
+
+# Keyset (cursor) pagination over any SELECT. `key` lists the (column, type)
+# pairs that order the rows; the last one must be unique, normally id.
+# Only page_size + 1 rows are ever read, however big the table is.
+def fetch_page(db, sql, params, key, page_size, after=None, before=None):
+    sql, params, cursor, backwards = page_query(sql, params, key, page_size, after, before)
+    rows = db.execute(sql, params).fetchall()
+    more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if backwards:
+        rows.reverse()
+        next_cursor = make_cursor(rows[-1], key) if rows else None
+        prev_cursor = make_cursor(rows[0], key) if rows and more else None
+    else:
+        next_cursor = make_cursor(rows[-1], key) if more else None
+        prev_cursor = make_cursor(rows[0], key) if rows and cursor is not None else None
+    return Page(rows, next_cursor, prev_cursor)
+
+
+# Yield the rows of an executed cursor, reading chunk_size rows at a time,
+# so a full table can be walked in constant memory
+def iter_rows(cursor, chunk_size):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        yield from rows
@@ -0,0 +1,60 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+from config import app
+
+
+class HashPoolBusy(Exception):
+    pass
+
+
+# Password hashing is CPU heavy, so at most PASSWORD_HASH_WORKERS hashes run
+# at once and at most PASSWORD_HASH_QUEUE more may wait. hashlib releases the
+# GIL while hashing, so the other request threads keep their share of the CPU.
+_executor = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_WORKERS'],
+                               thread_name_prefix='password-hash')
+_slots = threading.BoundedSemaphore(
+    app.config['PASSWORD_HASH_WORKERS'] + app.config['PASSWORD_HASH_QUEUE'])
+
+
+# Run fn on the hashing pool, raising HashPoolBusy when it is full
+def _run_on_pool(fn, *args):
+    if not _slots.acquire(blocking=False):
+        raise HashPoolBusy()
+    try:
+        future = _executor.submit(fn, *args)
+    except Exception:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda _: _slots.release())
+    return future.result()
+
+
+def hash_password(password, method=None):
+    return generate_password_hash(password, method=method or app.config['PASSWORD_HASH_METHOD'])
+
+
+def verify_password(pwhash, password):
+    return _run_on_pool(check_password_hash, pwhash, password)
+
+
+# Hash a password for storage on the pool, e.g. to upgrade it after login
+def rehash_password(password):
+    return _run_on_pool(hash_password, password)
+
+
+# The prefix werkzeug writes for a method, with its defaults filled in:
+# 'scrypt' -> 'scrypt:32768:8:1', 'pbkdf2' -> 'pbkdf2:sha256:1000000'
+@lru_cache(maxsize=8)
+def hash_prefix(method):
+    return generate_password_hash('', method).split('$', 1)[0]
+
+
+# True if a stored hash was made with a different method or cost than the
+# current PASSWORD_HASH_METHOD
+def needs_rehash(pwhash):
+    return pwhash.split('$', 1)[0] != hash_prefix(app.config['PASSWORD_HASH_METHOD'])
+
@@ -0,0 +1,100 @@
+import os
+import sqlite3
+import threading
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+# A bounded pool of open SQLite connections, reused across requests.
+# At most `size` connections exist at once; acquire() waits up to `timeout`
+# seconds for one to be released, then raises PoolTimeout.
+# A connection is owned by exactly one request between acquire() and
+# release(), so it is safe to hand it to whichever thread serves the next one.
+class ConnectionPool:
+    def __init__(self, connect, size, timeout=None):
+        self._connect = connect
+        self._idle = []
+        self._lock = threading.Lock()
+        self._released = threading.Condition(self._lock)
+        self._checked_out = 0
+        self._pid = os.getpid()
+        self.size = size
+        self.timeout = timeout
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+
+    def acquire(self):
+        with self._lock:
+            # Connections must not be shared with a forked worker
+            if self._pid != os.getpid():
+                self._idle = []
+                self._checked_out = 0
+                self._pid = os.getpid()
+            if self._checked_out >= self.size:
+                self.waits += 1
+                if not self._released.wait_for(lambda: self._checked_out < self.size, self.timeout):
+                    raise PoolTimeout(f"No database connection was free within {self.timeout} s")
+            self._checked_out += 1
+        try:
+            return self._checkout()
+        except Exception:
+            self._free_slot()
+            raise
+
+    def _checkout(self):
+        while True:
+            with self._lock:
+                db = self._idle.pop() if self._idle else None
+                if db is None:
+                    self.misses += 1
+            if db is None:
+                return self._connect()
+            if self._healthy(db):
+                with self._lock:
+                    self.hits += 1
+                return db
+            db.close()
+
+    def _free_slot(self):
+        with self._lock:
+            self._checked_out -= 1
+            self._released.notify()
+
+    def release(self, db):
+        try:
+            if db.in_transaction:
+                db.rollback()
+        except sqlite3.Error:
+            db.close()
+            db = None
+        with self._lock:
+            if self._pid == os.getpid():
+                self._checked_out -= 1
+                self._released.notify()
+                if db is not None:
+                    self._idle.append(db)
+                return
+        if db is not None:
+            db.close()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for db in idle:
+            db.close()
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'idle': len(self._idle), 'in_use': self._checked_out,
+                    'hits': self.hits, 'misses': self.misses, 'waits': self.waits}
+
+    @staticmethod
+    def _healthy(db):
+        try:
+            db.execute("SELECT 1").fetchone()
+            return True
+        except sqlite3.Error:
+            return False
@@ -0,0 +1,59 @@
+import re
+
+# SQL run by the borrow list and edit pages. 'flask check-query-plans'
+# plans these same strings, wrapped the way fetch_page runs them, so the
+# check cannot drift from what the routes execute.
+
+# Borrow lists are ordered by id, search results by rank then id
+ID_KEY = [('id', int)]
+RANK_KEY = [('score', float), ('id', int)]
+
+GUEST_LIST = """
+    SELECT * FROM BorrowDetails
+    WHERE borrower_id IS NULL OR borrower_id = 0
+"""
+
+USER_LIST = """
+    SELECT * FROM BorrowDetails
+    WHERE borrower_id = ?
+"""
+
+ADMIN_LIST = """
+    SELECT * FROM BorrowDetails
+"""
+
+# The whole table for admins, streamed rather than paged
+ADMIN_ALL = """
+    SELECT * FROM BorrowDetails
+    ORDER BY id ASC
+"""
+
+ADMIN_SEARCH = """
+    SELECT d.*, s.rank AS score
+    FROM BorrowsSearch s
+    JOIN BorrowDetails d ON d.id = s.rowid
+    WHERE BorrowsSearch MATCH ?
+"""
+
+USER_SEARCH = """
+    SELECT d.*, s.rank AS score
+    FROM BorrowsSearch s
+    JOIN BorrowDetails d ON d.id = s.rowid
+    WHERE BorrowsSearch MATCH ? AND d.borrower_id = ?
+"""
+
+
+# Turn free text into an FTS5 query: every word must match, as a prefix
+def search_expression(search_query):
+    words = re.findall(r'\w+', search_query)
+    return ' '.join('"' + word + '"*' for word in words)
+
+
+EDIT_BORROW = """
+    SELECT * FROM BorrowDetails
+    WHERE id = ?
+"""
+
+UPDATE_BORROW = "SELECT * FROM Borrows WHERE id = ?"
+
+BOOK_BORROWS = "SELECT COUNT(*) FROM Borrows WHERE book_ref = ?"
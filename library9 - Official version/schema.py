@@ -0,0 +1,528 @@
+import sqlite3
+import sys
+from datetime import datetime
+
+import click
+
+import overdue
+import queries
+from config import app
+from pagination import page_query
+
+
+# Migration step: replace `table` with a copy built by create_sql (which
+# must create `<table>_new`) and filled by copy_sql. This is SQLite's
+# documented table rebuild: the table's indexes, and every trigger and
+# view (any of which may refer to it), are saved from sqlite_master,
+# dropped, and created again once the new table has the old name.
+def rebuild_table(table, create_sql, copy_sql):
+    def step(db):
+        saved = db.execute("""SELECT type, name, sql FROM sqlite_master
+                              WHERE sql IS NOT NULL
+                                AND (type IN ('trigger', 'view') OR (type = 'index' AND tbl_name = ?))
+                              ORDER BY type = 'trigger', type = 'index'""", (table,)).fetchall()
+        db.execute(create_sql)
+        db.execute(copy_sql)
+        for kind, name, _ in saved:
+            db.execute(f"DROP {kind.upper()} IF EXISTS {name}")
+        db.execute(f"DROP TABLE {table}")
+        db.execute(f"ALTER TABLE {table}_new RENAME TO {table}")
+        for _, _, sql in saved:
+            db.execute(sql)
+    return step
+
+
+# Ordered schema migrations as (version, description, steps).
+# A step is either an SQL statement or a function taking the connection.
+# Never edit a migration once it has shipped, append a new one instead.
+MIGRATIONS = [
+    (1, 'Create Borrows and Users tables', [
+        '''CREATE TABLE IF NOT EXISTS Borrows (
+                  id             INTEGER PRIMARY KEY,
+                  book_id        INTEGER,
+                  borrower_id    TEXT,
+                  book_title     TEXT,
+                  category       TEXT,
+                  picture        TEXT,
+                  borrow_date    TEXT,
+                  return_date    TEXT,
+                  Instructions   TEXT,
+                  update_time    TEXT,
+                  FOREIGN KEY (borrower_id) REFERENCES Users(id)
+                )''',
+        '''CREATE TABLE IF NOT EXISTS Users (
+                  id             INTEGER PRIMARY KEY,
+                  username       TEXT UNIQUE NOT NULL,
+                  password       TEXT NOT NULL,
+                  real_name      TEXT,
+                  email          TEXT,
+                  role           INTEGER NOT NULL CHECK(role IN (0, 1))
+                )''',
+    ]),
+    (2, 'Index Borrows for the list, edit and due-date access paths', [
+        "CREATE INDEX IF NOT EXISTS idx_borrows_borrower ON Borrows(borrower_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_book_id ON Borrows(book_id)",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_return_date ON Borrows(return_date)",
+    ]),
+    (3, 'Full-text search index over Borrows, kept in sync by triggers', [
+        '''CREATE VIRTUAL TABLE IF NOT EXISTS BorrowsSearch USING fts5(
+                  book_title, username, category, instructions,
+                  prefix = '2 3'
+                )''',
+        '''INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+           SELECT b.id, b.book_title, u.username, b.category, b.Instructions
+           FROM Borrows b
+           LEFT JOIN Users u ON b.borrower_id = u.id''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_insert AFTER INSERT ON Borrows BEGIN
+               INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+               VALUES (new.id, new.book_title,
+                       (SELECT username FROM Users WHERE id = new.borrower_id),
+                       new.category, new.Instructions);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_update AFTER UPDATE ON Borrows BEGIN
+               DELETE FROM BorrowsSearch WHERE rowid = old.id;
+               INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+               VALUES (new.id, new.book_title,
+                       (SELECT username FROM Users WHERE id = new.borrower_id),
+                       new.category, new.Instructions);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_delete AFTER DELETE ON Borrows BEGIN
+               DELETE FROM BorrowsSearch WHERE rowid = old.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username ON Users BEGIN
+               UPDATE BorrowsSearch SET username = new.username
+               WHERE rowid IN (SELECT id FROM Borrows WHERE borrower_id = new.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON Users BEGIN
+               UPDATE BorrowsSearch SET username = NULL
+               WHERE rowid IN (SELECT id FROM Borrows WHERE borrower_id = old.id);
+           END''',
+    ]),
+    (4, 'Change counters behind the borrow list ETags', [
+        '''CREATE TABLE IF NOT EXISTS BorrowVersions (
+                  scope          TEXT PRIMARY KEY,
+                  version        INTEGER NOT NULL
+                )''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_insert AFTER INSERT ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(new.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_update AFTER UPDATE ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(old.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+               INSERT INTO BorrowVersions (scope, version)
+               SELECT 'user:' || IFNULL(new.borrower_id, 0), 1
+               WHERE IFNULL(new.borrower_id, 0) IS NOT IFNULL(old.borrower_id, 0)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_delete AFTER DELETE ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(old.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        # Only the user columns the borrow lists show; a password rehash on
+        # login must not make every list stale
+        '''CREATE TRIGGER IF NOT EXISTS users_version_update AFTER UPDATE OF username, email ON Users BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || new.id, 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+    ]),
+    (5, 'Books and Categories catalog; Borrows references books by id', [
+        '''CREATE TABLE IF NOT EXISTS Categories (
+                  id             INTEGER PRIMARY KEY,
+                  name           TEXT UNIQUE NOT NULL
+                )''',
+        '''INSERT OR IGNORE INTO Categories (name) VALUES
+                  ('Supreme'), ('Fiction'), ('Science Fiction'), ('Biography'),
+                  ('Computer Science'), ('Children'), ('History'), ('Psychology'),
+                  ('Art & Photography'), ('Health & Fitness'), ('Comics & Graphic Novels')''',
+        '''INSERT OR IGNORE INTO Categories (name)
+           SELECT DISTINCT category FROM Borrows WHERE category IS NOT NULL AND category <> \'\'''',
+        '''CREATE TABLE IF NOT EXISTS Books (
+                  id             INTEGER PRIMARY KEY,
+                  book_id        TEXT UNIQUE NOT NULL,
+                  title          TEXT,
+                  category_id    INTEGER,
+                  picture        TEXT,
+                  FOREIGN KEY (category_id) REFERENCES Categories(id)
+                )''',
+        # One catalog entry per book_id, taken from its most recent borrow
+        '''INSERT INTO Books (book_id, title, category_id, picture)
+           SELECT CAST(b.book_id AS TEXT), b.book_title, c.id, b.picture
+           FROM Borrows b
+           LEFT JOIN Categories c ON c.name = b.category
+           WHERE b.id IN (SELECT MAX(id) FROM Borrows WHERE book_id IS NOT NULL GROUP BY CAST(book_id AS TEXT))''',
+        # Borrows whose own title or category differed from the one kept
+        # for their book keep their original values here, for review with
+        # 'flask book-conflicts'
+        '''CREATE TABLE IF NOT EXISTS BookConflicts (
+                  borrow_id      INTEGER PRIMARY KEY,
+                  book_id        TEXT NOT NULL,
+                  book_title     TEXT,
+                  category       TEXT
+                )''',
+        '''INSERT INTO BookConflicts (borrow_id, book_id, book_title, category)
+           SELECT b.id, bk.book_id, b.book_title, b.category
+           FROM Borrows b
+           JOIN Books bk ON bk.book_id = CAST(b.book_id AS TEXT)
+           LEFT JOIN Categories c ON c.id = bk.category_id
+           WHERE b.book_title IS NOT bk.title OR NULLIF(b.category, '') IS NOT c.name''',
+        '''CREATE TABLE Borrows_new (
+                  id             INTEGER PRIMARY KEY,
+                  book_ref       INTEGER,
+                  borrower_id    INTEGER,
+                  borrow_date    TEXT,
+                  return_date    TEXT,
+                  Instructions   TEXT,
+                  update_time    TEXT,
+                  FOREIGN KEY (book_ref) REFERENCES Books(id),
+                  FOREIGN KEY (borrower_id) REFERENCES Users(id)
+                )''',
+        '''INSERT INTO Borrows_new (id, book_ref, borrower_id, borrow_date, return_date, Instructions, update_time)
+           SELECT b.id, bk.id, b.borrower_id, b.borrow_date, b.return_date, b.Instructions, b.update_time
+           FROM Borrows b
+           LEFT JOIN Books bk ON bk.book_id = CAST(b.book_id AS TEXT)''',
+        # Triggers on Users name Borrows, so they go before the table is swapped
+        "DROP TRIGGER IF EXISTS users_search_update",
+        "DROP TRIGGER IF EXISTS users_search_delete",
+        "DROP TABLE Borrows",
+        "ALTER TABLE Borrows_new RENAME TO Borrows",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_borrower ON Borrows(borrower_id, id)",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_book_ref ON Borrows(book_ref)",
+        "CREATE INDEX IF NOT EXISTS idx_borrows_return_date ON Borrows(return_date)",
+        # Borrows with their book, category and borrower, in the old column names
+        '''CREATE VIEW IF NOT EXISTS BorrowDetails AS
+           SELECT b.id, b.book_ref, bk.book_id, bk.title AS book_title, c.name AS category,
+                  bk.picture, b.borrower_id, b.borrow_date, b.return_date, b.Instructions,
+                  b.update_time, u.username, u.email
+           FROM Borrows b
+           LEFT JOIN Books bk ON bk.id = b.book_ref
+           LEFT JOIN Categories c ON c.id = bk.category_id
+           LEFT JOIN Users u ON u.id = b.borrower_id''',
+        "DELETE FROM BorrowsSearch",
+        '''INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+           SELECT id, book_title, username, category, Instructions FROM BorrowDetails''',
+        "INSERT INTO BorrowsSearch (BorrowsSearch) VALUES ('optimize')",
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_insert AFTER INSERT ON Borrows BEGIN
+               INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+               SELECT id, book_title, username, category, Instructions
+               FROM BorrowDetails WHERE id = new.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_update AFTER UPDATE ON Borrows BEGIN
+               DELETE FROM BorrowsSearch WHERE rowid = old.id;
+               INSERT INTO BorrowsSearch (rowid, book_title, username, category, instructions)
+               SELECT id, book_title, username, category, Instructions
+               FROM BorrowDetails WHERE id = new.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_search_delete AFTER DELETE ON Borrows BEGIN
+               DELETE FROM BorrowsSearch WHERE rowid = old.id;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF username ON Users BEGIN
+               UPDATE BorrowsSearch SET username = new.username
+               WHERE rowid IN (SELECT id FROM Borrows WHERE borrower_id = new.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON Users BEGIN
+               UPDATE BorrowsSearch SET username = NULL
+               WHERE rowid IN (SELECT id FROM Borrows WHERE borrower_id = old.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS books_search_update AFTER UPDATE OF title, category_id ON Books
+           WHEN new.title IS NOT old.title OR new.category_id IS NOT old.category_id BEGIN
+               UPDATE BorrowsSearch
+               SET book_title = new.title,
+                   category = (SELECT name FROM Categories WHERE id = new.category_id)
+               WHERE rowid IN (SELECT id FROM Borrows WHERE book_ref = new.id);
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_insert AFTER INSERT ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(new.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_update AFTER UPDATE ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(old.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+               INSERT INTO BorrowVersions (scope, version)
+               SELECT 'user:' || IFNULL(new.borrower_id, 0), 1
+               WHERE IFNULL(new.borrower_id, 0) IS NOT IFNULL(old.borrower_id, 0)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_version_delete AFTER DELETE ON Borrows BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               VALUES ('all', 1), ('user:' || IFNULL(old.borrower_id, 0), 1)
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS books_version_update AFTER UPDATE ON Books
+           WHEN new.title IS NOT old.title OR new.category_id IS NOT old.category_id
+             OR new.book_id IS NOT old.book_id OR new.picture IS NOT old.picture BEGIN
+               INSERT INTO BorrowVersions (scope, version)
+               SELECT DISTINCT 'user:' || IFNULL(borrower_id, 0), 1 FROM Borrows WHERE book_ref = new.id
+               UNION ALL SELECT 'all', 1
+               ON CONFLICT(scope) DO UPDATE SET version = version + 1;
+           END''',
+    ]),
+    (6, 'Index each borrower\'s loans by due date for the overdue views', [
+        "CREATE INDEX IF NOT EXISTS idx_borrows_borrower_due ON Borrows(borrower_id, return_date)",
+    ]),
+    (7, 'Store borrow and return dates as day numbers, update times as Unix seconds', [
+        rebuild_table('Borrows', '''CREATE TABLE Borrows_new (
+                  id             INTEGER PRIMARY KEY,
+                  book_ref       INTEGER,
+                  borrower_id    INTEGER,
+                  borrow_date    INTEGER,
+                  return_date    INTEGER,
+                  Instructions   TEXT,
+                  update_time    INTEGER,
+                  FOREIGN KEY (book_ref) REFERENCES Books(id),
+                  FOREIGN KEY (borrower_id) REFERENCES Users(id)
+                )''',
+            # Days since 1970-01-01; update_time was written in local time
+            '''INSERT INTO Borrows_new (id, book_ref, borrower_id, borrow_date, return_date, Instructions, update_time)
+               SELECT id, book_ref, borrower_id,
+                      CAST(julianday(borrow_date) - 2440587.5 AS INTEGER),
+                      CAST(julianday(return_date) - 2440587.5 AS INTEGER),
+                      Instructions,
+                      CAST(strftime('%s', update_time, 'utc') AS INTEGER)
+               FROM Borrows'''),
+    ]),
+    (8, 'Borrow counts per user and per category, kept up to date by triggers', [
+        '''CREATE TABLE IF NOT EXISTS UserBorrowCounts (
+                  user_id        INTEGER PRIMARY KEY,
+                  borrows        INTEGER NOT NULL
+                )''',
+        '''CREATE TABLE IF NOT EXISTS CategoryBorrowCounts (
+                  category_id    INTEGER PRIMARY KEY,
+                  borrows        INTEGER NOT NULL
+                )''',
+        # Guests count as user 0, books without a category as category 0
+        '''INSERT INTO UserBorrowCounts (user_id, borrows)
+           SELECT IFNULL(borrower_id, 0) AS user_id, COUNT(*)
+           FROM Borrows GROUP BY user_id''',
+        '''INSERT INTO CategoryBorrowCounts (category_id, borrows)
+           SELECT IFNULL(bk.category_id, 0) AS category_id, COUNT(*)
+           FROM Borrows b LEFT JOIN Books bk ON bk.id = b.book_ref
+           GROUP BY 1''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_counts_insert AFTER INSERT ON Borrows BEGIN
+               INSERT INTO UserBorrowCounts (user_id, borrows)
+               VALUES (IFNULL(new.borrower_id, 0), 1)
+               ON CONFLICT(user_id) DO UPDATE SET borrows = borrows + 1;
+               INSERT INTO CategoryBorrowCounts (category_id, borrows)
+               VALUES (IFNULL((SELECT category_id FROM Books WHERE id = new.book_ref), 0), 1)
+               ON CONFLICT(category_id) DO UPDATE SET borrows = borrows + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_counts_update AFTER UPDATE OF borrower_id, book_ref ON Borrows
+           WHEN new.borrower_id IS NOT old.borrower_id OR new.book_ref IS NOT old.book_ref BEGIN
+               UPDATE UserBorrowCounts SET borrows = borrows - 1
+               WHERE user_id = IFNULL(old.borrower_id, 0);
+               INSERT INTO UserBorrowCounts (user_id, borrows)
+               VALUES (IFNULL(new.borrower_id, 0), 1)
+               ON CONFLICT(user_id) DO UPDATE SET borrows = borrows + 1;
+               UPDATE CategoryBorrowCounts SET borrows = borrows - 1
+               WHERE category_id = IFNULL((SELECT category_id FROM Books WHERE id = old.book_ref), 0);
+               INSERT INTO CategoryBorrowCounts (category_id, borrows)
+               VALUES (IFNULL((SELECT category_id FROM Books WHERE id = new.book_ref), 0), 1)
+               ON CONFLICT(category_id) DO UPDATE SET borrows = borrows + 1;
+           END''',
+        '''CREATE TRIGGER IF NOT EXISTS borrows_counts_delete AFTER DELETE ON Borrows BEGIN
+               UPDATE UserBorrowCounts SET borrows = borrows - 1
+               WHERE user_id = IFNULL(old.borrower_id, 0);
+               UPDATE CategoryBorrowCounts SET borrows = borrows - 1
+               WHERE category_id = IFNULL((SELECT category_id FROM Books WHERE id = old.book_ref), 0);
+           END''',
+        # A book moving category takes all its borrows with it
+        '''CREATE TRIGGER IF NOT EXISTS books_counts_update AFTER UPDATE OF category_id ON Books
+           WHEN new.category_id IS NOT old.category_id BEGIN
+               UPDATE CategoryBorrowCounts
+               SET borrows = borrows - (SELECT COUNT(*) FROM Borrows WHERE book_ref = new.id)
+               WHERE category_id = IFNULL(old.category_id, 0);
+               INSERT INTO CategoryBorrowCounts (category_id, borrows)
+               SELECT IFNULL(new.category_id, 0), COUNT(*) FROM Borrows WHERE book_ref = new.id
+               ON CONFLICT(category_id) DO UPDATE SET borrows = borrows + excluded.borrows;
+           END''',
+    ]),
+]
+
+# The queries the list, search, edit and overdue pages run, with sample
+# parameters. Paged queries are wrapped by page_query() exactly as
+# fetch_page() runs them, for the first page and for a page after a
+# cursor. check-query-plans fails if any of them scans Borrows or Books.
+def hot_queries():
+    page_size = app.config['BORROW_PAGE_SIZE']
+    today = 20089
+    paged = {
+        'guest list': (queries.GUEST_LIST, (), queries.ID_KEY, '100'),
+        'user list': (queries.USER_LIST, (1,), queries.ID_KEY, '100'),
+        'admin list': (queries.ADMIN_LIST, (), queries.ID_KEY, '100'),
+        'admin search': (queries.ADMIN_SEARCH, ('"harry"*',), queries.RANK_KEY, '-1.5,100'),
+        'user search': (queries.USER_SEARCH, ('"harry"*', 1), queries.RANK_KEY, '-1.5,100'),
+        'overdue': overdue.due_query(today) + (overdue.DUE_KEY, '19875,100'),
+        'user overdue': overdue.due_query(today, None, 1) + (overdue.DUE_KEY, '19875,100'),
+        'due soon': overdue.due_query(today, 7) + (overdue.DUE_KEY, '20090,100'),
+    }
+    checked = {}
+    for name, (sql, params, key, cursor) in paged.items():
+        checked[f"{name} page"] = page_query(sql, params, key, page_size)[:2]
+        checked[f"{name} next page"] = page_query(sql, params, key, page_size, after=cursor)[:2]
+        checked[f"{name} previous page"] = page_query(sql, params, key, page_size, before=cursor)[:2]
+    checked.update({
+        'edit borrow': (queries.EDIT_BORROW, (1,)),
+        'update borrow': (queries.UPDATE_BORROW, (1,)),
+        'borrows of a book': (queries.BOOK_BORROWS, (1,)),
+        'book by book id': ("SELECT id FROM Books WHERE book_id = ?", ('123',)),
+    })
+    return checked
+
+
+def current_version(db):
+    db.execute('''CREATE TABLE IF NOT EXISTS schema_version (
+                  version        INTEGER PRIMARY KEY,
+                  description    TEXT,
+                  applied_at     TEXT
+                )''')
+    row = db.execute("SELECT MAX(version) FROM schema_version").fetchone()
+    return row[0] or 0
+
+
+# Apply every migration newer than the recorded version, one transaction each
+def migrate(db):
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        # BEGIN IMMEDIATE takes the write lock, so two workers starting
+        # together cannot both apply the same migration
+        db.execute("BEGIN IMMEDIATE")
+        try:
+            if version <= current_version(db):
+                db.rollback()
+                continue
+            for step in steps:
+                if callable(step):
+                    step(db)
+                else:
+                    db.execute(step)
+            db.execute("INSERT INTO schema_version (version, description, applied_at) VALUES (?, ?, ?)",
+                       (version, description, datetime.now().strftime("%Y-%m-%d %H:%M:%S")))
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        applied.append((version, description))
+    return applied
+
+
+def init_db():
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        db.execute("PRAGMA journal_mode = WAL")
+        return migrate(db)
+    finally:
+        db.close()
+
+
+# Migrations applied when the app was loaded
+startup_migrations = []
+
+
+# Apply pending migrations when the app is loaded and log each one to
+# stderr, so server logs and every flask command show what changed
+def migrate_on_startup():
+    applied = init_db()
+    for version, description in applied:
+        print(f"Applied migration {version}: {description}", file=sys.stderr)
+    startup_migrations.extend(applied)
+    return applied
+
+
+# Table names and the aliases the hot queries give them
+SCANNED_TABLES = {'b': 'Borrows', 'Borrows': 'Borrows', 'bk': 'Books', 'Books': 'Books'}
+
+# The first admin list page walks Borrows in id order and stops after
+# page_size + 1 rows. Its SCAN is fine as long as no sort is needed, which
+# would read every row first. (The ?all=1 view streams the whole table
+# on purpose and is not checked.)
+BOUNDED_SCANS = {'admin list page'}
+
+
+# {query name: (problem, EXPLAIN QUERY PLAN lines)} for every hot query
+# that full-scans Borrows or Books
+def find_table_scans(db):
+    scans = {}
+    for name, (sql, params) in hot_queries().items():
+        plan = db.execute("EXPLAIN QUERY PLAN " + sql, params).fetchall()
+        details = [row[3] for row in plan]
+        for detail in details:
+            words = detail.split()
+            if name in BOUNDED_SCANS:
+                if detail.startswith('USE TEMP B-TREE'):
+                    scans[name] = ("sort before LIMIT", details)
+                    break
+            elif words[:1] == ['SCAN'] and len(words) > 1 and words[1] in SCANNED_TABLES:
+                scans[name] = (f"full scan of {SCANNED_TABLES[words[1]]}", details)
+                break
+    return scans
+
+
+# flask --app main init-db
+@app.cli.command('init-db')
+def init_db_command():
+    applied = init_db()
+    for version, description in applied:
+        click.echo(f"Applied migration {version}: {description}")
+    # Loading the app to run this command already migrated the database
+    if startup_migrations:
+        click.echo(f"Applied {len(startup_migrations)} migrations while loading the app (logged above).")
+    elif not applied:
+        click.echo("Database schema is up to date.")
+    report_book_conflicts(summary=True)
+
+
+# Print the borrows whose title or category was replaced by their book's
+# catalog entry when migration 5 built the catalog
+def report_book_conflicts(summary=False):
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        if not db.execute("SELECT 1 FROM sqlite_master WHERE name = 'BookConflicts'").fetchone():
+            return
+        rows = db.execute("""
+            SELECT k.borrow_id, k.book_id, k.book_title, k.category, bk.title, c.name
+            FROM BookConflicts k
+            JOIN Books bk ON bk.book_id = k.book_id
+            LEFT JOIN Categories c ON c.id = bk.category_id
+            ORDER BY k.book_id, k.borrow_id
+        """).fetchall()
+    finally:
+        db.close()
+    if summary:
+        if rows:
+            click.echo(f"{len(rows)} borrows had a title or category that differs from their book's "
+                       f"catalog entry, see 'flask book-conflicts'.")
+        return
+    for borrow_id, book_id, title, category, book_title, book_category in rows:
+        click.echo(f"borrow #{borrow_id} book {book_id}: was {title!r} / {category!r}, "
+                   f"now {book_title!r} / {book_category!r}")
+    click.echo(f"{len(rows)} borrows differ from their book's catalog entry.")
+
+
+# flask --app main book-conflicts
+@app.cli.command('book-conflicts')
+def book_conflicts_command():
+    report_book_conflicts()
+
+
+# flask --app main check-query-plans
+@app.cli.command('check-query-plans')
+def check_query_plans_command():
+    db = sqlite3.connect(app.config['DATABASE'])
+    try:
+        scans = find_table_scans(db)
+    finally:
+        db.close()
+    for name, (problem, details) in scans.items():
+        click.echo(f"{name}: {problem}")
+        for detail in details:
+            click.echo(f"    {detail}")
+    if scans:
+        raise SystemExit(1)
+    click.echo(f"All {len(hot_queries())} hot queries use an index.")
+
@@ -0,0 +1,122 @@
+import copy
+import threading
+import time
+from collections import Counter
+
+from borrows import format_day
+from config import app, connect_db
+from counts import category_borrow_counts
+
+# Each metric is a GROUP BY over Borrows. `after_id` restricts it to the
+# borrows added since a snapshot, so a snapshot can be brought up to date
+# with small queries. {hint} is NOT INDEXED for those: a full build is
+# fastest over the covering indexes, but for a few new rows SQLite would
+# still pick the index and scan all of it instead of the rowid range.
+AGGREGATES = {
+    'by_book': "SELECT book_ref, COUNT(*) FROM Borrows{hint} WHERE id > ? GROUP BY book_ref",
+    'by_borrow_date': "SELECT borrow_date, COUNT(*) FROM Borrows{hint} WHERE id > ? GROUP BY borrow_date",
+    'by_return_date': "SELECT return_date, COUNT(*) FROM Borrows{hint} WHERE id > ? GROUP BY return_date",
+}
+TOTALS = '''SELECT COUNT(*), IFNULL(MAX(id), 0), IFNULL(SUM(return_date - borrow_date), 0),
+                   COUNT(return_date - borrow_date)
+            FROM Borrows WHERE id > ?'''
+
+
+def _version(db):
+    row = db.execute("SELECT version FROM BorrowVersions WHERE scope = 'all'").fetchone()
+    return row[0] if row else 0
+
+
+# Aggregate counters over every borrow with an id above after_id
+class Snapshot:
+    def __init__(self, db, after_id=0):
+        self.version = _version(db)
+        self.taken_at = time.time()
+        hint = ' NOT INDEXED' if after_id else ''
+        self.counters = {name: Counter(dict(db.execute(sql.format(hint=hint), (after_id,)).fetchall()))
+                         for name, sql in AGGREGATES.items()}
+        self.total, self.max_id, self.loan_days, self.loans_with_dates = db.execute(TOTALS, (after_id,)).fetchone()
+
+    # This snapshot with the borrows added since it was taken folded in, as
+    # a new Snapshot: one already handed to a request is never changed
+    # under it. None unless the only changes were inserts: every insert,
+    # update or delete bumps the 'all' version once, so the version moved by
+    # exactly the number of new rows if and only if nothing else changed.
+    def extended(self, db):
+        version = _version(db)
+        added = db.execute("SELECT COUNT(*) FROM Borrows WHERE id > ?", (self.max_id,)).fetchone()[0]
+        if version - self.version != added:
+            return None
+        if not added:
+            return self
+        delta = Snapshot(db, self.max_id)
+        snapshot = copy.copy(self)
+        snapshot.counters = {name: counter + delta.counters[name] for name, counter in self.counters.items()}
+        snapshot.total += delta.total
+        snapshot.max_id = delta.max_id
+        snapshot.loan_days += delta.loan_days
+        snapshot.loans_with_dates += delta.loans_with_dates
+        snapshot.version = version
+        return snapshot
+
+
+# The dashboard snapshot, shared by the threads of one worker
+_snapshot = None
+_rebuilding = False
+_lock = threading.Lock()
+
+
+def _rebuild():
+    global _snapshot, _rebuilding
+    db = connect_db(readonly=True)
+    try:
+        snapshot = Snapshot(db)
+        with _lock:
+            _snapshot = snapshot
+    finally:
+        db.close()
+        _rebuilding = False
+
+
+# Current aggregate snapshot. New borrows are folded in incrementally.
+# After edits or deletes it is rebuilt from scratch in the background, at
+# most once every STATS_MAX_AGE seconds, and the previous snapshot is
+# served meanwhile. Only the first request of a worker waits for a build.
+# A snapshot is never changed once returned, so callers read it unlocked.
+def get_snapshot(db):
+    global _snapshot, _rebuilding
+    with _lock:
+        if _snapshot is None:
+            _snapshot = Snapshot(db)
+            return _snapshot
+        extended = _snapshot.extended(db)
+        if extended is not None:
+            _snapshot = extended
+        elif not _rebuilding and time.time() - _snapshot.taken_at >= app.config['STATS_MAX_AGE']:
+            _rebuilding = True
+            threading.Thread(target=_rebuild, daemon=True).start()
+        return _snapshot
+
+
+# Everything the dashboard shows. Overdue figures come from the return
+# date counts, so they are correct for `today` without a rescan. The
+# per-category counts are read live from their summary table.
+def dashboard(db, today):
+    snapshot = get_snapshot(db)
+    counters = snapshot.counters
+    top_books = counters['by_book'].most_common(app.config['STATS_TOP_BOOKS'])
+    titles = {row[0]: (row[1], row[2]) for row in db.execute(
+        f"SELECT id, book_id, title FROM Books WHERE id IN ({','.join('?' * len(top_books))})",
+        [ref for ref, _ in top_books])} if top_books else {}
+    since = today - app.config['STATS_DAYS'] + 1
+    overdue = sum(count for day, count in counters['by_return_date'].items() if day is not None and day < today)
+    return {
+        'taken_at': snapshot.taken_at,
+        'total': snapshot.total,
+        'by_category': category_borrow_counts(db),
+        'by_day': [(format_day(day), counters['by_borrow_date'].get(day, 0)) for day in range(since, today + 1)],
+        'top_books': [titles.get(ref, (None, None)) + (count,) for ref, count in top_books],
+        'average_loan_days': snapshot.loan_days / snapshot.loans_with_dates if snapshot.loans_with_dates else 0,
+        'overdue': overdue,
+        'overdue_rate': overdue / snapshot.total if snapshot.total else 0,
+    }
@@ -0,0 +1,35 @@
+import threading
+import time
+from collections import OrderedDict, deque
+
+
+# Sliding-window rate limiter: at most `limit` hits per key in `window`
+# seconds. Only the most recently used `max_keys` keys are remembered.
+class RateLimiter:
+    def __init__(self, limit, window, max_keys=10000):
+        self.limit = limit
+        self.window = window
+        self.max_keys = max_keys
+        self._hits = OrderedDict()
+        self._lock = threading.Lock()
+
+    # Record a hit for key, returning False if it is over the limit
+    def hit(self, key):
+        now = time.monotonic()
+        with self._lock:
+            hits = self._hits.get(key)
+            if hits is None:
+                hits = self._hits[key] = deque()
+            self._hits.move_to_end(key)
+            while hits and hits[0] <= now - self.window:
+                hits.popleft()
+            if len(hits) >= self.limit:
+                return False
+            hits.append(now)
+            while len(self._hits) > self.max_keys:
+                self._hits.popitem(last=False)
+            return True
+
+    def reset(self, key):
+        with self._lock:
+            self._hits.pop(key, None)